@@ -2,14 +2,21 @@ import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.models import Model
 from tensorflow.keras import layers
-from layers import StochasticDepth, TalkingHeadAttention, LayerScale, RandomDrop
+from layers import StochasticDepth, TalkingHeadAttention, LayerScale, RandomDrop, NeighborFeatures, LatentAttention, SlotAdd, SlotConcat, recomputed
 from tensorflow.keras.losses import mse, categorical_crossentropy
 import numpy as np
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+import horovod.tensorflow as hvd
 import utils
 
 class PET(keras.Model):
     """Point-Edge Transformer"""
+    #train_step components measured by compile(instrument=True)
+    timed_components = ['generator_forward','evt_forward','generator_backward','evt_backward','optimizers','ema']
+
     def __init__(self,
                  num_feat,
                  num_evt,
@@ -23,6 +30,13 @@ class PET(keras.Model):
                  num_diffusion = 7,
                  num_pid = 5,
                  num_add_gen = 0, #Number of additional PID features gen only
+                 mask_attention = False, #Ignore padded particles in the body attention
+                 attention_block = None, #Drop trailing blocks of padding, needs mask_attention
+                 cell_knn = False, #First gen local layer reads eta-phi neighbors from input_gen_knn
+                 cross_attention = False, #Reco tokens cross-attend to a separate gen encoder
+                 latent_attention = 0, #Number of latent tokens of the body attention, 0 for full attention
+                 ema_device = None, #Device of the EMA copies, e.g. /CPU:0 to keep them in host memory
+                 recompute = False, #Recompute the activations of the body layers in the backward pass
                  ):
 
         super(PET, self).__init__()
@@ -38,9 +52,17 @@ class PET(keras.Model):
         self.layer_scale_init=layer_scale_init
         self.ema=0.999
         self.num_steps = 64
+        self.num_steps_evt = 512
         self.shape = (-1,1,1)
         self.num_add_gen = num_add_gen
         self.K = K
+        self.mask_attention = mask_attention
+        self.attention_block = attention_block
+        self.cell_knn = cell_knn
+        self.cross_attention = cross_attention
+        self.latent_attention = latent_attention
+        self.recompute = recompute
+        self.set_jit_samplers({})
 
         
         input_reco = layers.Input(shape=(None, num_feat), name='input_reco')
@@ -53,27 +75,30 @@ class PET(keras.Model):
         input_gen_evt = layers.Input((num_evt),name='input_gen_evt')
 
         input_time = layers.Input((1),name = 'input_time')
+        #Precomputed (P,K) neighbor indices of the gen particles, see utils.cell_neighbors
+        input_gen_knn = [layers.Input((None,K),dtype='int32',name='input_gen_knn')] if cell_knn else []
 
 
-        outputs_body, gen_encoding = self.PET_body(input_reco,
+        outputs_body, gen_encoding, body_cache, body_time = self.PET_body(input_reco,
                                                    input_gen,
                                                    input_reco_mask,
                                                    input_gen_mask,
                                                    input_reco_evt,
                                                    input_gen_evt,
                                                    input_time,
-                                                   K = self.K)
+                                                   K = self.K,
+                                                   input_gen_knn = input_gen_knn)
         
         input_list = [input_reco,input_gen,
                       input_reco_mask,input_gen_mask,
-                      input_reco_evt,input_gen_evt,input_time]
+                      input_reco_evt,input_gen_evt,input_time] + input_gen_knn
         
             
             
         self.body = keras.Model(inputs=input_list,
                                 outputs=outputs_body)
                 
-        outputs_generator = self.PET_generator(outputs_body,
+        outputs_generator, head_cache = self.PET_generator(outputs_body,
                                                input_reco_mask,
                                                gen_encoding,
                                                input_gen_mask,
@@ -84,7 +109,7 @@ class PET(keras.Model):
                                                   input_reco_mask,
                                                   input_gen,
                                                   input_gen_mask,
-                                                  ],
+                                                  ] + input_gen_knn,
                                           outputs=outputs_generator)
 
         self.generator = keras.Model(inputs=input_list,
@@ -102,7 +127,7 @@ class PET(keras.Model):
         # )
 
 
-        outputs = self.TabTransformer(
+        outputs, evt_cache, evt_time = self.TabTransformer(
             input_reco_evt,
             input_gen_evt,
             gen_encoding,
@@ -116,13 +141,43 @@ class PET(keras.Model):
                                        input_gen_evt,
                                        input_gen,
                                        input_gen_mask,                                       
-                                       input_time],
+                                       input_time] + input_gen_knn,
                                outputs=outputs)
         
 
-        self.ema_evt = keras.models.clone_model(self.model_evt)
-        self.ema_body = keras.models.clone_model(self.body)
-        self.ema_head = keras.models.clone_model(self.generator_head)
+        self.ema_device = ema_device
+        with tf.device(ema_device):
+            self.ema_evt = keras.models.clone_model(self.model_evt)
+            self.ema_body = keras.models.clone_model(self.body)
+            self.ema_head = keras.models.clone_model(self.generator_head)
+
+        #The gen-level inputs do not change during sampling, so the EMA models are
+        #split into conditioning encoders, evaluated once per event, and denoisers
+        #that read the cached encoder outputs at every diffusion step.
+        evt_inputs = [input_reco_evt,input_gen_evt,input_gen,input_gen_mask,input_time] + input_gen_knn
+        head_inputs = [outputs_body,input_reco_mask,input_gen,input_gen_mask] + input_gen_knn
+        #Time conditioning is split off as well: the Fourier embeddings and the adaLN
+        #modulations only depend on the sampler grid and the event conditioning.
+        self.ema_views = SamplerViews(
+            evt_encoder = get_view(self.ema_evt, evt_inputs,
+                                   [input_gen_evt,input_gen,input_gen_mask] + input_gen_knn, evt_cache),
+            evt_time = get_view(self.ema_evt, evt_inputs, [input_time], evt_time),
+            evt_denoiser = get_view(self.ema_evt, evt_inputs,
+                                    [input_reco_evt] + evt_time + evt_cache, [outputs]),
+            body_encoder = get_view(self.ema_body, input_list,
+                                    [input_gen,input_gen_mask,input_gen_evt] + input_gen_knn, body_cache),
+            body_time = get_view(self.ema_body, input_list, [input_time], body_time[:1]),
+            body_modulation = get_view(self.ema_body, input_list,
+                                       body_time[:1] + body_cache[:1], body_time[1:]),
+            body_denoiser = get_view(self.ema_body, input_list,
+                                     [input_reco,input_reco_mask] + body_time[1:] + body_cache[1:],
+                                     [outputs_body]),
+            head_encoder = get_view(self.ema_head, head_inputs,
+                                    [input_gen,input_gen_mask] + input_gen_knn, head_cache),
+            head_denoiser = get_view(self.ema_head, head_inputs,
+                                     [outputs_body,input_reco_mask] + head_cache,
+                                     [outputs_generator]),
+        )
 
         self.loss_evt_tracker = keras.metrics.Mean(name="evt")        
         self.loss_tracker = keras.metrics.Mean(name="loss")
@@ -145,13 +200,15 @@ class PET(keras.Model):
 
     def train_step(self, inputs):        
         batch_size = tf.shape(inputs['input_reco_evt'])[0]
+        self.start_timer(inputs)
 
-        with tf.GradientTape(persistent=True) as tape:            
-            t = tf.random.uniform((batch_size,1))                
-            logsnr, alpha, sigma = get_logsnr_alpha_sigma(t)
+        t = tf.random.uniform((batch_size,1))                
+        logsnr, alpha, sigma = get_logsnr_alpha_sigma(t)
+        
+        with tf.GradientTape() as tape_part, self.timed('generator_forward'):
             
             eps = tf.random.normal((tf.shape(inputs['input_reco'][:,:,:self.num_diffusion])),
-                                   dtype=tf.float32)*inputs['input_reco_mask'][:,:,None]
+                                   dtype=inputs['input_reco'].dtype)*inputs['input_reco_mask'][:,:,None]
             
             perturbed_x = tf.concat([alpha[:,None]*inputs['input_reco'][:,:,:self.num_diffusion] + eps * sigma[:,None],
                                      inputs['input_reco'][:,:,self.num_diffusion:]],-1)
@@ -160,7 +217,8 @@ class PET(keras.Model):
             v_pred_part = self.generator([perturbed_x,
                                           inputs['input_gen'],
                                           inputs['input_reco_mask'],inputs['input_gen_mask'],
-                                          inputs['input_reco_evt'],inputs['input_gen_evt'],t])
+                                          inputs['input_reco_evt'],inputs['input_gen_evt'],t]
+                                         + self.knn_inputs(inputs))
         
             v_pred_part = tf.reshape(v_pred_part,(tf.shape(v_pred_part)[0], -1))
             v_part = alpha[:,None] * eps - sigma[:,None] * inputs['input_reco'][:,:,:self.num_diffusion]
@@ -169,48 +227,73 @@ class PET(keras.Model):
             #loss_part = tf.reduce_mean(tf.square(v_part-v_pred_part))
             loss_part = tf.reduce_sum(tf.square(v_part-v_pred_part))/(tf.reduce_sum(inputs['input_reco_mask']))
             
-            
-            #Event model
-            
-            eps = tf.random.normal((batch_size,self.num_evt),dtype=tf.float32)
+        #Event model
+        with tf.GradientTape() as tape_evt, self.timed('evt_forward'):
+            eps = tf.random.normal((batch_size,self.num_evt),dtype=inputs['input_reco_evt'].dtype)
             perturbed_x = alpha*inputs['input_reco_evt'] + eps * sigma            
             v_pred = self.model_evt([perturbed_x,
                                      inputs['input_gen_evt'],
                                      inputs['input_gen'],
                                      inputs['input_gen_mask'],
-                                     t])
+                                     t] + self.knn_inputs(inputs))
             
             v_evt = alpha * eps - sigma * inputs['input_reco_evt']
             loss_evt = tf.reduce_mean(tf.square(v_pred-v_evt))
         
-            loss = loss_evt + loss_part
+        loss = loss_evt + loss_part
             
         trainable_vars = self.model_evt.trainable_variables + self.generator_head.trainable_variables
         self.loss_evt_tracker.update_state(loss_evt)
             
-            
-        self.body_optimizer.minimize(loss_part,self.body.trainable_variables,tape=tape)
-        self.optimizer.minimize(loss,trainable_vars,tape=tape)
-
+        self.apply_updates(tape_part,tape_evt,loss_part,loss_evt,self.body.trainable_variables,trainable_vars)
         
         self.loss_tracker.update_state(loss)
         self.loss_part_tracker.update_state(loss_part)
 
-
-
-        
-        for weight, ema_weight in zip(self.model_evt.weights, self.ema_evt.weights):
-            ema_weight.assign(self.ema * ema_weight + (1 - self.ema) * weight)
-            
-        for weight, ema_weight in zip(self.generator_head.weights, self.ema_head.weights):
-            ema_weight.assign(self.ema * ema_weight + (1 - self.ema) * weight)
-
-        for weight, ema_weight in zip(self.body.weights, self.ema_body.weights):
-            ema_weight.assign(self.ema * ema_weight + (1 - self.ema) * weight)
-
-
         return {m.name: m.result() for m in self.metrics}
 
+    def knn_inputs(self,inputs):
+        #Extra body inputs when the first local layer uses precomputed neighbors
+        return [inputs['input_gen_knn']] if self.cell_knn else []
+
+    def apply_updates(self,tape_part,tape_evt,loss_part,loss_evt,body_vars,head_vars):
+        """Body optimizer step on loss_part, head optimizer step on
+        loss_part + loss_evt, followed by the EMA update of all models.
+        The generator and the event model only share variables, so each loss
+        is differentiated once and the gradients are routed to both optimizers"""
+        with self.timed('generator_backward'):
+            grads_part = get_gradients(self.body_optimizer,tape_part,loss_part,body_vars + head_vars)
+        with self.timed('evt_backward'):
+            grads_evt = get_gradients(self.optimizer,tape_evt,loss_evt,head_vars)
+        grads_head = [add_gradients(grad_part,grad_evt) for grad_part,grad_evt
+                      in zip(grads_part[len(body_vars):],grads_evt)]
+
+        def update(grads):
+            with self.timed('optimizers'):
+                apply_gradients([self.body_optimizer,self.optimizer],grads,[body_vars,head_vars],
+                                self.allreduce)
+            with self.timed('ema'):
+                self.ema_update(self.optimizer.iterations)
+        if self.accumulator is None:
+            update(grads_part[:len(body_vars)] + grads_head)
+        else:
+            self.accumulator(grads_part[:len(body_vars)] + grads_head,update)
+
+    def start_timer(self,inputs):
+        if self.step_timer is not None:
+            self.step_timer.start(tf.shape(inputs['input_reco_evt'])[0],
+                                  tf.reduce_sum(inputs['input_reco_mask']))
+
+    @contextlib.contextmanager
+    def timed(self,component):
+        #Name scope of a train_step component, timed with compile(instrument=True)
+        with tf.name_scope(component):
+            if self.step_timer is None:
+                yield
+            else:
+                with self.step_timer.time(component):
+                    yield
+
     
     def test_step(self, inputs):
         batch_size = tf.shape(inputs['input_reco_evt'])[0]
@@ -220,7 +303,7 @@ class PET(keras.Model):
         logsnr, alpha, sigma = get_logsnr_alpha_sigma(t)
         
         eps = tf.random.normal((tf.shape(inputs['input_reco'][:,:,:self.num_diffusion])),
-                               dtype=tf.float32)*inputs['input_reco_mask'][:,:,None]
+                               dtype=inputs['input_reco'].dtype)*inputs['input_reco_mask'][:,:,None]
         
         perturbed_x = tf.concat([alpha[:,None]*inputs['input_reco'][:,:,:self.num_diffusion] + eps * sigma[:,None],
                                  inputs['input_reco'][:,:,self.num_diffusion:]],-1)
@@ -228,7 +311,8 @@ class PET(keras.Model):
         v_pred_part = self.generator([perturbed_x,
                                       inputs['input_gen'],
                                       inputs['input_reco_mask'],inputs['input_gen_mask'],
-                                      inputs['input_reco_evt'],inputs['input_gen_evt'],t])
+                                      inputs['input_reco_evt'],inputs['input_gen_evt'],t]
+                                     + self.knn_inputs(inputs))
         
         v_pred_part = tf.reshape(v_pred_part,(tf.shape(v_pred_part)[0], -1))
         v_part = alpha[:,None] * eps - sigma[:,None] * inputs['input_reco'][:,:,:self.num_diffusion]
@@ -240,13 +324,13 @@ class PET(keras.Model):
         
         #Event model
         
-        eps = tf.random.normal((batch_size,self.num_evt),dtype=tf.float32)
+        eps = tf.random.normal((batch_size,self.num_evt),dtype=inputs['input_reco_evt'].dtype)
         perturbed_x = alpha*inputs['input_reco_evt'] + eps * sigma            
         v_pred = self.model_evt([perturbed_x,
                                  inputs['input_gen_evt'],
                                  inputs['input_gen'],
                                  inputs['input_gen_mask'],
-                                 t])
+                                 t] + self.knn_inputs(inputs))
             
         v_evt = alpha * eps - sigma * inputs['input_reco_evt']
         loss_evt = tf.reduce_mean(tf.square(v_pred-v_evt))
@@ -290,7 +374,7 @@ class PET(keras.Model):
         scale,shift = tf.split(cond_token,2,-1)
         
         layer = layers.Dense(self.projection_dim,activation='swish')(input_reco_evt)
-        layer = layer*(1.0+scale) + shift
+        layer = layer*(scale+1.0) + shift
         
         for _ in range(num_layer-1):
             layer = layers.LayerNormalization(epsilon=1e-6)(layer)
@@ -311,15 +395,18 @@ class PET(keras.Model):
                        dropout=0.0,
                        ):
     
+        gen_mask = cast(input_gen_mask,compute_dtype())
         time = FourierProjection(input_time,self.projection_dim)[:,None,:]
+        time_cache = [time]
         
-        gen_embedding = get_encoding(input_gen,self.projection_dim)*input_gen_mask
+        gen_embedding = get_encoding(input_gen,self.projection_dim)*gen_mask
         gen_embedding = tf.reduce_mean(gen_embedding,1)[:,None,:]
         time_particle = tf.concat([time,gen_embedding],1)
 
         shared_dense = layers.Dense(self.projection_dim)
         
         gen_evt = layers.Dense(self.projection_dim)(input_gen_evt)[:,None,:]
+        gen_cache = [gen_embedding,gen_evt]
         encoded = layers.Dense(self.projection_dim)(input_reco_evt)[:,None,:]
         encoded = encoded + gen_evt
         encoded = tf.concat([encoded,gen_evt,time_particle],1)
@@ -341,8 +428,8 @@ class PET(keras.Model):
             encoded = layers.Add()([x3,x2])
 
         encoded = layers.GroupNormalization(groups=1)(encoded)        
-        outputs = layers.Dense(self.num_evt)(encoded[:,0])    
-        return outputs
+        outputs = cast(layers.Dense(self.num_evt)(encoded[:,0]),'float32')
+        return outputs, gen_cache, time_cache
 
     
                 
@@ -355,8 +442,18 @@ class PET(keras.Model):
                  input_gen_evt,
                  input_time,
                  K,
+                 input_gen_knn = [],
                  ):
 
+        #Activations follow the mixed precision policy, masks are cast to match
+        reco_mask = cast(input_reco_mask,compute_dtype())
+        gen_mask = cast(input_gen_mask,compute_dtype())
+        output_mask = reco_mask
+        if self.mask_attention and self.attention_block:
+            #Trailing padded blocks of the reco particles are dropped at the inputs,
+            #so the trimming adds no node between the layers of the body
+            input_reco, input_reco_mask = trim_padding(input_reco,input_reco_mask,self.attention_block)
+            reco_mask = cast(input_reco_mask,compute_dtype())
         encoded = get_encoding(input_reco,self.projection_dim)
         gen_encoded = get_encoding(input_gen,self.projection_dim)
         
@@ -364,94 +461,175 @@ class PET(keras.Model):
         #Event and time Conditional info
         time = FourierProjection(input_time,self.projection_dim)
         cond_gen = get_encoding(input_gen_evt,self.projection_dim)
+        gen_cache = [cond_gen]
+        if self.num_local > 0 or self.mask_attention or self.cross_attention:
+            #The gen mask is only an input of the denoiser when something reads it
+            gen_cache.append(input_gen_mask)
+        time_cache = [time]
         time = tf.concat([time,cond_gen],-1)
         cond = layers.Dense(self.projection_dim,activation='swish')(time)
 
         if self.num_local > 0:
             #Local info        
-            coord_shift_reco = tf.multiply(999., tf.cast(tf.equal(input_reco_mask, 0), dtype='float32'))
-            coord_shift_gen = tf.multiply(999., tf.cast(tf.equal(input_gen_mask, 0), dtype='float32'))
-            
             points_reco = input_reco
             points_gen = input_gen
             local_features = input_reco
             local_gens = input_gen
             
-            for _ in range(self.num_local):
-                local_features = get_neighbors(coord_shift_reco + points_reco,
-                                               coord_shift_gen + points_gen,
+            for i in range(self.num_local):
+                #points_gen is local_gens
+                gen_cache.append(local_gens)
+                local_features = get_neighbors(points_reco,points_gen,
                                                local_features,local_gens,
-                                               self.projection_dim,K)
+                                               self.projection_dim,K,
+                                               input_reco_mask,input_gen_mask,
+                                               recompute=self.recompute)
                 
-                local_gens = get_neighbors(coord_shift_gen + points_gen,
-                                           coord_shift_gen + points_gen,
+                #The noisy reco particles are searched above at every step, the gen
+                #neighbors of the first layer can come from the eta-phi cell list
+                local_gens = get_neighbors(points_gen,
+                                           points_gen,
                                            local_gens,local_gens,
-                                           self.projection_dim,K)
+                                           self.projection_dim,K,
+                                           input_gen_mask,input_gen_mask,
+                                           indices = input_gen_knn[0] if input_gen_knn and i == 0 else None,
+                                           recompute=self.recompute)
                 
                 points_reco = local_features
                 points_gen = local_gens
 
-            gen_encoded = layers.Add()([local_gens,gen_encoded])*input_gen_mask
-            encoded = layers.Add()([local_features,encoded,local_gens])*input_reco_mask
+            gen_cache.append(local_gens)
+            gen_encoded = layers.Add()([local_gens,gen_encoded])*gen_mask
+            #Reco slots read the gen features of the same slot
+            encoded = SlotAdd()([local_features,encoded,local_gens])*reco_mask
             
-        encoded = tf.concat([encoded,gen_encoded],1)        
+        if self.cross_attention:
+            #Gen tokens only go through their own encoder, the keys and values it
+            #gives to every reco layer are evaluated once per event when sampling
+            gen_encoded, gen_keys = self.GenEncoder(gen_encoded,gen_mask)
+            gen_cache += gen_keys
+        else:
+            gen_cache.append(gen_encoded)
+        if self.mask_attention:
+            #Key mask and normalization mask built once for all layers
+            num_reco = tf.shape(output_mask)[1]
+            if self.cross_attention:
+                token_mask = reco_mask
+                num_packed = tf.shape(encoded)[1]
+            else:
+                encoded, token_mask, num_packed = pack_tokens(encoded,gen_encoded,reco_mask,gen_mask,
+                                                              self.attention_block)
+        elif self.cross_attention:
+            token_mask = None
+        else:
+            encoded = tf.concat([encoded,gen_encoded],1)
+            token_mask = None
         skip_connection = []
-        for i in range(self.num_layers//2):
-
+        for i in range(self.num_layers):
+            if i >= self.num_layers//2:
+                #Second half reads the skip connections in reverse order
+                encoded = layers.Dense(self.projection_dim)(tf.concat([encoded,skip_connection.pop()],-1))
             c = layers.Dense(6*self.projection_dim,
                              kernel_initializer="zeros",
                              bias_initializer = "zeros")(cond[:,None])
-            shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp  = tf.split(c,6,-1)
-            
-            x1 = layers.GroupNormalization(groups=1)(encoded)
-            x1 = x1*(1. + scale_msa) + shift_msa
-            
-            updates = layers.MultiHeadAttention(num_heads=self.num_heads,
-                                                key_dim=self.projection_dim//self.num_heads)(x1,x1)
-            updates = gate_msa*updates
-            x2 = layers.Add()([updates,encoded])
-            x3 = layers.GroupNormalization(groups=1)(x2)
-            x3 = x3*(1. + scale_mlp) + shift_mlp
-            x3 = layers.Dense(2*self.projection_dim,activation="gelu")(x3)
-            x3 = layers.Dense(self.projection_dim)(x3)
-            x3 = gate_mlp*x3
-
-            encoded = layers.Add()([x3,x2])
-            skip_connection.append(encoded)
+            time_cache.append(c)
+            keys = [gen_keys.pop(0),gen_keys.pop(0),gen_mask] if self.cross_attention else []
+            encoded = self.body_layer(encoded,c,token_mask,*keys)
+            if i < self.num_layers//2:
+                skip_connection.append(encoded)
+
+        if self.mask_attention:
+            #Back to the padded reco length
+            encoded = tf.pad(encoded[:,:num_packed],[[0,0],[0,num_reco - num_packed],[0,0]])
+                       
+        return encoded[:,:self.max_part]*output_mask, gen_encoded, gen_cache, time_cache
 
-        for i in range(self.num_layers//2):
-            encoded = layers.Dense(self.projection_dim)(tf.concat([encoded,skip_connection.pop()],-1))
-            c = layers.Dense(6*self.projection_dim,
-                             kernel_initializer="zeros",
-                             bias_initializer = "zeros")(cond[:,None])
-            shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp  = tf.split(c,6,-1)
-            
-            x1 = layers.GroupNormalization(groups=1)(encoded)
-            x1 = x1*(1. + scale_msa) + shift_msa
+    def body_layer(self,encoded,c,token_mask=None,key=None,value=None,key_mask=None):
+        #adaLN transformer layer of the body with the modulations c
+        attention_mask = None if token_mask is None else tf.transpose(token_mask,[0,2,1]) > 0
+        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp  = tf.split(c,6,-1)
+        
+        x1 = layers.GroupNormalization(groups=1)(encoded,mask=token_mask)
+        x1 = x1*(scale_msa + 1.) + shift_msa
+        updates = self.self_attention(x1,token_mask,attention_mask)
+        updates = gate_msa*updates
+        x2 = layers.Add()([updates,encoded])
+        if key is not None:
+            x2 = self.cross_update(x2,token_mask,key,value,key_mask)
+        x3 = layers.GroupNormalization(groups=1)(x2,mask=token_mask)
+        x3 = x3*(scale_mlp + 1.) + shift_mlp
+        x3 = self.checkpoint(layers.Dense(2*self.projection_dim,activation="gelu"))(x3)
+        x3 = layers.Dense(self.projection_dim)(x3)
+        x3 = gate_mlp*x3
+        return layers.Add()([x3,x2])
+
+    def checkpoint(self,layer):
+        """layer, with the activations inside it recomputed in the backward
+        pass when recompute is set (see layers.recomputed)"""
+        return recomputed(layer) if self.recompute else layer
+
+    def self_attention(self,x,token_mask,attention_mask):
+        #Body token mixing, through learned latents when latent_attention is set
+        if self.latent_attention:
+            return self.checkpoint(LatentAttention(self.projection_dim,self.num_heads,self.latent_attention))(x,mask=token_mask)
+        return self.checkpoint(layers.MultiHeadAttention(num_heads=self.num_heads,
+                                                         key_dim=self.projection_dim//self.num_heads))(x,x,attention_mask=attention_mask)
+
+    def GenEncoder(self,encoded,gen_mask):
+        """Transformer over the gen tokens alone. Returns the encoded tokens and
+        the keys and values of the cross attention of each body layer."""
+        attention_mask = tf.transpose(gen_mask,[0,2,1]) > 0
+        keys = []
+        #Normalized tokens are multiplied by the mask, which also stops Keras from
+        #propagating it as a layer mask
+        for i in range(self.num_layers):
+            x1 = layers.GroupNormalization(groups=1)(encoded,mask=gen_mask)*gen_mask
             updates = layers.MultiHeadAttention(num_heads=self.num_heads,
-                                                key_dim=self.projection_dim//self.num_heads)(x1,x1)
-            updates = gate_msa*updates
+                                                key_dim=self.projection_dim//self.num_heads)(x1,x1,attention_mask=attention_mask)
             x2 = layers.Add()([updates,encoded])
-            x3 = layers.GroupNormalization(groups=1)(x2)
-            x3 = x3*(1. + scale_mlp) + shift_mlp
+            x3 = layers.GroupNormalization(groups=1)(x2,mask=gen_mask)*gen_mask
             x3 = layers.Dense(2*self.projection_dim,activation="gelu")(x3)
             x3 = layers.Dense(self.projection_dim)(x3)
-            x3 = gate_mlp*x3
-
-            encoded = layers.Add()([x3,x2])
-
-            
-                       
-        return encoded[:,:self.max_part]*input_reco_mask, gen_encoded
-
-
-    def compile(self,body_optimizer,head_optimizer):
+            encoded = layers.Add()([x3,x2])*gen_mask
+
+            x = layers.GroupNormalization(groups=1)(encoded,mask=gen_mask)*gen_mask
+            keys += [layers.Dense(self.projection_dim)(x), layers.Dense(self.projection_dim)(x)]
+        return encoded, keys
+
+    def cross_update(self,encoded,token_mask,key,value,key_mask):
+        #Residual cross attention, zero at initialization like the gated updates
+        x = layers.GroupNormalization(groups=1)(encoded,mask=token_mask)
+        updates = cross_attention(x,key,value,key_mask,self.num_heads,self.projection_dim)
+        return layers.Add()([updates,encoded])
+
+
+    def compile(self,body_optimizer,head_optimizer,jit_compile=False,ema_interval=1,accum_steps=1,
+                instrument=False,allreduce=None):
+        #jit_compile runs train_step and test_step with XLA. Horovod allreduce
+        #inside XLA needs HOROVOD_ENABLE_XLA_OPS=1 when running on more than 1 rank.
+        #allreduce is the GradientAllreduce of the body and head gradients, needed on more than 1 rank.
+        #accum_steps > 1 updates the weights with the mean gradient of accum_steps batches.
+        #instrument times the train_step components, read by utils.StepTimeLogger
+        assert not (jit_compile and instrument), 'ERROR: the step timer is not supported by XLA'
+        assert not (jit_compile and self.attention_block), 'ERROR: attention_block uses dynamic shapes, not supported by XLA'
         super(PET, self).compile(experimental_run_tf_function=False,
                                   weighted_metrics=[],
+                                  jit_compile=jit_compile,
                                   #run_eagerly=True
                                   )
-        self.body_optimizer = body_optimizer
-        self.optimizer = head_optimizer
+        self.body_optimizer = loss_scale(body_optimizer)
+        self.optimizer = loss_scale(head_optimizer)
+        self.allreduce = allreduce
+        #EMA of all models every ema_interval optimizer steps
+        self.ema_update = WeightEMA(self.model_evt.weights + self.generator_head.weights + self.body.weights,
+                                    self.ema_evt.weights + self.ema_head.weights + self.ema_body.weights,
+                                    self.ema,ema_interval,self.ema_device)
+        self.accumulator = None
+        if accum_steps > 1:
+            self.accumulator = GradientAccumulator(
+                self.body.trainable_variables + self.model_evt.trainable_variables
+                + self.generator_head.trainable_variables,accum_steps)
+        self.step_timer = StepTimer(self.timed_components) if instrument else None
 
 
     def PET_generator(
@@ -464,82 +642,304 @@ class PET(keras.Model):
     ):
 
 
-        coord_shift_reco = tf.multiply(999., tf.cast(tf.equal(input_reco_mask, 0), dtype='float32'))
-        coord_shift_gen = tf.multiply(999., tf.cast(tf.equal(input_gen_mask, 0), dtype='float32'))
-
-        gen_embedding = get_encoding(input_gen,self.projection_dim)*input_gen_mask
+        gen_embedding = get_encoding(input_gen,self.projection_dim)*cast(input_gen_mask,compute_dtype())
         gen_embedding = tf.reduce_mean(gen_embedding,1)
+        gen_cache = [gen_embedding]
         encoded = encoded + gen_embedding[:,None]
 
         
-        # encoded = get_neighbors(coord_shift_reco + encoded,
-        #                         coord_shift_gen + gen_embedding,
+        # encoded = get_neighbors(encoded,
+        #                         gen_embedding,
         #                         encoded,gen_embedding,
-        #                         self.projection_dim,K)
-
-        encoded = layers.Dense(self.num_diffusion)(encoded)*input_reco_mask
-        return encoded
-
-
+        #                         self.projection_dim,K,
+        #                         input_reco_mask,input_gen_mask)
+
+        encoded = cast(layers.Dense(self.num_diffusion)(encoded),'float32')*input_reco_mask
+        return encoded, gen_cache
+
+
+
+    @tf.__internal__.tracking.no_automatic_dependency_tracking
+    def ema_weights(self):
+        """Model of the EMA copies, to save and load only the weights used by the samplers"""
+        return EMAWeights(self.ema_evt,self.ema_body,self.ema_head)
+
+    def set_jit_samplers(self,samplers):
+        self.jit_samplers = samplers
+
+    def get_sampler(self,sampler,jit_compile=False):
+        """SamplerCalls of the sampler method, compiled with XLA if jit_compile.
+        The entry points are traced once per model, XLA compiles once per
+        padded split size."""
+        if jit_compile:
+            assert not self.attention_block, 'ERROR: attention_block uses dynamic shapes, not supported by XLA'
+        if (sampler,jit_compile) not in self.jit_samplers:
+            self.jit_samplers[(sampler,jit_compile)] = SamplerCalls(self,getattr(self,SAMPLERS[sampler]),
+                                                                    jit_compile)
+        return self.jit_samplers[(sampler,jit_compile)]
+
+    def generate(self,gen_part,gen_mask,gen_evt,nsplit = 2,use_tqdm=False,time_tables=False,
+                 sampler='ddpm',evt_steps=None,part_steps=None,jit_compile=False,gen_knn=None,
+                 batch_size=None,memory_budget=None,trim_block=None,pipeline=False):
+        """Sample reco events and particles given the preprocessed gen inputs.
+        sampler picks one of SAMPLERS. evt_steps and part_steps set the number of
+        steps of the event and particle samplers, defaulting to num_steps_evt and
+        num_steps. DDPM evaluates the model twice per step, DDIM and DPM once.
+        jit_compile runs the sampler loops with XLA. Splits are padded to a
+        bucketed size (see bucket_size), so the sampler sees few distinct
+        batch sizes and XLA compiles a few times at most. gen_knn are the
+        precomputed neighbor indices of the gen particles, needed with cell_knn.
+        The events are sampled in splits of batch_size events, of as many events
+        as fit in memory_budget bytes (see event_bytes), or else in nsplit splits.
+        A split that runs out of memory is retried with half as many events per
+        split. The throughput of each split is stored in split_stats.
+        With trim_block, the events of all splits are sampled first. The
+        particles are then sampled with the events sorted by predicted
+        multiplicity, each split trimmed to the multiple of trim_block slots
+        above its largest multiplicity. The output keeps the input order.
+        Needs mask_attention, the unmasked attention sees the padded slots.
+        With pipeline, the events and particle masks of the next split are
+        prepared on a worker thread while the particles of the current split
+        are sampled, and the sampled particles are copied to the host and
+        post-processed on a second worker."""
+        sample_fn = self.get_sampler(sampler,jit_compile)
+        evt_steps = self.num_steps_evt if evt_steps is None else evt_steps
+        part_steps = self.num_steps if part_steps is None else part_steps
+        assert (gen_knn is not None) == bool(self.cell_knn), 'ERROR: gen_knn is required with, and only with, cell_knn'
+        assert trim_block is None or self.mask_attention, 'ERROR: trim_block needs mask_attention'
+
+        def inputs(index):
+            return [gen_part[index],gen_mask[index],gen_evt[index],
+                    gen_knn[index] if self.cell_knn else None]
+
+        nevts = gen_evt.shape[0]
+        sizes = self.split_sizes(nevts,nsplit,batch_size,memory_budget)
+        self.split_stats = []
+        with contextlib.ExitStack() as stack:
+            worker, post = [stack.enter_context(ThreadPoolExecutor(1)) if pipeline else None for _ in range(2)]
+            if trim_block is None:
+                outputs = self.run_splits(
+                    lambda index,pad_size,prepared: (
+                        self.generate_particles(sample_fn,*inputs(index),prepared[1],part_steps,
+                                                time_tables,pad_size,post=post),
+                        prepared[0]),
+                    nevts,sizes,'all',use_tqdm,
+                    prepare=lambda index,pad_size: self.prepare_split(sample_fn,*inputs(index),evt_steps,
+                                                                      time_tables,pad_size),
+                    worker=worker)
+                parts, evt = zip(*outputs)
+                order = None
+            else:
+                evt = self.run_splits(
+                    lambda index,pad_size: self.generate_events(sample_fn,*inputs(index),evt_steps,
+                                                                time_tables,pad_size),
+                    nevts,sizes,'events',use_tqdm)
+                npids = utils.revert_npart(np.concatenate(evt)[:,-self.num_pid:])
+                order = np.argsort(np.sum(npids,-1),kind='stable')
+                parts = self.run_splits(
+                    lambda index,pad_size,masks: self.generate_particles(sample_fn,*inputs(order[index]),masks,
+                                                                         part_steps,time_tables,pad_size,
+                                                                         trim_block,post),
+                    nevts,sizes,'particles',use_tqdm,
+                    prepare=lambda index,pad_size: self.particle_masks(npids[order[index]],pad_size),
+                    worker=worker)
+            if post is not None:
+                parts = [part.result() for part in parts]
+
+        parts = np.concatenate(parts)
+        if order is not None:
+            parts[order] = parts.copy()
+        return parts, np.concatenate(evt)
+
+    def run_splits(self,fn,nevts,sizes,stage,use_tqdm=False,prepare=None,worker=None):
+        """Outputs of fn(index,pad_size) for the slices index of consecutive
+        splits of nevts events, or of fn(index,pad_size,prepare(index,pad_size))
+        with prepare. Given a worker executor, prepare runs there one split
+        ahead of fn. A split that runs out of memory is retried with half as
+        many events per split. Adds the throughput of each split to split_stats."""
+        outputs = []
+        stops = list(np.cumsum(sizes))
+        pad_size = sizes[0]
+        ahead = None
+        progress = tqdm(total=nevts, desc=f'Processing Splits ({stage})', unit='evt') if use_tqdm else None
+
+        start = 0
+        while start < nevts:
+            stop = stops[0]
+            begin = time.perf_counter()
+            try:
+                if prepare is None:
+                    output = fn(slice(start,stop),pad_size)
+                elif worker is None:
+                    output = fn(slice(start,stop),pad_size,prepare(slice(start,stop),pad_size))
+                else:
+                    #A split prepared ahead is dropped if a back-off changed the splits
+                    if ahead is None or ahead[0] != (start,stop,pad_size):
+                        ahead = ((start,stop,pad_size),worker.submit(prepare,slice(start,stop),pad_size))
+                    prepared = ahead[1].result()
+                    ahead = None
+                    if len(stops) > 1:
+                        ahead = ((stop,stops[1],pad_size),worker.submit(prepare,slice(stop,stops[1]),pad_size))
+                    output = fn(slice(start,stop),pad_size,prepared)
+            except tf.errors.ResourceExhaustedError:
+                size = (stop - start)//2
+                if size == 0:
+                    raise
+                #Back off: the remaining events in splits of half the size
+                stops = list(range(start + size,nevts,size)) + [nevts]
+                pad_size = size
+                continue
+            elapsed = time.perf_counter() - begin
+            self.split_stats.append({'stage': stage, 'events': stop - start, 'seconds': elapsed,
+                                     'events_per_second': (stop - start)/elapsed})
+            if progress is not None:
+                progress.update(stop - start)
+                progress.set_postfix(events_per_second=f"{(stop - start)/elapsed:.1f}")
+            outputs.append(output)
+            start = stops.pop(0)
+        if progress is not None:
+            progress.close()
+        return outputs
 
-    def generate(self,gen_part,gen_mask,gen_evt,nsplit = 2,use_tqdm=False):
-        evt_info = []
-        part_info = []
-
-        part_splits = np.array_split(gen_part,nsplit)
-        mask_part_splits = np.array_split(gen_mask,nsplit)
-        evt_splits = np.array_split(gen_evt,nsplit)
-        
-        for split in tqdm(range(nsplit), total=nsplit, desc='Processing Splits') if use_tqdm else range(nsplit):
-            evt = self.DDPMSampler(part_splits[split],
-                                   mask_part_splits[split],
-                                   evt_splits[split],
-                                   self.ema_evt,
-                                   data_shape=[part_splits[split].shape[0],self.num_evt],
-                                   num_steps = 512,
-                                   const_shape = [-1,1]).numpy()
-
-            evt_info.append(evt)
-
-            npids = utils.revert_npart(evt[:,-self.num_pid:])
-            one_hot_pid = make_pid(npids,self.max_part)
-            nparts = np.expand_dims(np.clip(np.sum(npids,-1),
-                                    1,self.max_part),-1) #5 is the minimum in the datasets used for training
-
-            mask = np.expand_dims(
-                np.tile(np.arange(self.max_part),(nparts.shape[0],1)) < np.tile(nparts,(1,self.max_part)),-1)
-        
-            assert np.sum(np.sum(mask.reshape(mask.shape[0],-1),-1,keepdims=True)-nparts)==0, 'ERROR: Particle mask does not match the expected number of particles'
-
-            parts = self.DDPMSampler(part_splits[split],
-                                     mask_part_splits[split],
-                                     evt_splits[split],
-                                     [self.ema_body,self.ema_head],
-                                     data_shape=[part_splits[split].shape[0],
-                                                 self.max_part,self.num_diffusion],
-                                     evt=evt,
-                                     num_steps = self.num_steps,
-                                     const_shape = self.shape,
-                                     mask=mask.astype(np.float32),
-                                     pids = one_hot_pid).numpy()
-            part_info.append(np.concatenate([parts,one_hot_pid],-1)*mask)            
-        return np.concatenate(part_info),np.concatenate(evt_info)
-
-    def evaluate_models(self,head,body,x,
-                        cond_gen,mask_reco,mask_gen,
-                        cond_reco_evt,cond_gen_evt, t):
-        v = body([x,cond_gen,mask_reco,mask_gen,
-                  cond_reco_evt,cond_gen_evt,t], training=False)
-        v = head([v,mask_reco,cond_gen,mask_gen],training=False)
+    def prepare_split(self,sample_fn,gen_part,gen_mask,gen_evt,gen_knn,
+                      evt_steps,time_tables,pad_size):
+        """Events of one split of generate, with the particle pids and mask"""
+        evt = self.generate_events(sample_fn,gen_part,gen_mask,gen_evt,gen_knn,
+                                   evt_steps,time_tables,pad_size)
+        return evt, self.particle_masks(utils.revert_npart(evt[:,-self.num_pid:]),pad_size)
+
+    def pad_split(self,pad_size,*inputs):
+        #Split inputs padded to the bucket of pad_size events
+        size = bucket_size(inputs[0].shape[0],pad_size)
+        return [None if x is None else pad_batch(x,size) for x in inputs]
+
+    def generate_events(self,sample_fn,gen_part,gen_mask,gen_evt,gen_knn,
+                        evt_steps,time_tables,pad_size):
+        """Sampled events of one split"""
+        nevts = gen_evt.shape[0]
+        gen_part, gen_mask, gen_evt, gen_knn = self.pad_split(pad_size,gen_part,gen_mask,gen_evt,gen_knn)
+        knn_split = self.knn_inputs({'input_gen_knn':gen_knn})
+        evt_cond = self.ema_views.evt_encoder([gen_evt,
+                                               gen_part,
+                                               gen_mask] + knn_split,training=False)
+        return sample_fn.events(evt_cond,evt_steps,time_tables).numpy()[:nevts]
+
+    def particle_masks(self,npids,pad_size):
+        """One-hot pids and particle mask of the multiplicities per pid npids
+        of one split, padded to the bucket of pad_size events"""
+        npids, = self.pad_split(pad_size,npids)
+        one_hot_pid = make_pid(npids,self.max_part)
+        nparts = np.clip(np.sum(npids,-1,keepdims=True),1,self.max_part) #5 is the minimum in the datasets used for training
+        mask = (np.arange(self.max_part)[None] < nparts)[:,:,None]
+        return one_hot_pid, mask
+
+    def generate_particles(self,sample_fn,gen_part,gen_mask,gen_evt,gen_knn,masks,
+                           part_steps,time_tables,pad_size,trim_block=None,post=None):
+        """Sampled particles of one split with the pids and mask of particle_masks,
+        trimmed to a multiple of trim_block slots while sampling. Given a post
+        executor, returns the future of finish_particles run there."""
+        views = self.ema_views
+        nevts = gen_evt.shape[0]
+        one_hot_pid, mask = masks
+        gen_part, gen_mask, gen_evt, gen_knn = self.pad_split(pad_size,gen_part,gen_mask,gen_evt,gen_knn)
+        knn_split = self.knn_inputs({'input_gen_knn':gen_knn})
+
+        num_slots = self.max_part
+        if trim_block is not None:
+            num_slots = min(-(-int(np.sum(mask,1).max())//trim_block)*trim_block,self.max_part)
+
+        part_cond = [views.body_encoder([gen_part,
+                                         gen_mask,
+                                         gen_evt] + knn_split,training=False),
+                     views.head_encoder([gen_part,
+                                         gen_mask] + knn_split,training=False)]
+        parts = sample_fn.particles(part_cond,mask[:,:num_slots].astype(np.float32),
+                                    one_hot_pid[:,:num_slots],part_steps,time_tables)
+        if post is None:
+            return self.finish_particles(parts,one_hot_pid,mask,nevts)
+        return post.submit(self.finish_particles,parts,one_hot_pid,mask,nevts)
+
+    def finish_particles(self,parts,one_hot_pid,mask,nevts):
+        #Sampled particles on the host, padded back to max_part slots, with the pids
+        parts = parts.numpy()
+        parts = np.pad(parts,[(0,0),(0,self.max_part - parts.shape[1]),(0,0)])
+        return (np.concatenate([parts,one_hot_pid],-1)*mask)[:nevts]
+
+    def event_bytes(self):
+        """Rough peak float32 memory per event of the particle sampler: copies
+        and MLP expansion of the body tokens, the attention scores, the neighbor
+        features and the cached conditioning of every layer"""
+        tokens = self.max_part*self.projection_dim
+        return 4*(16*tokens + 2*self.num_heads*self.max_part**2
+                  + 2*self.K*tokens + 2*self.num_layers*tokens)
+
+    def split_sizes(self,nevts,nsplit=2,batch_size=None,memory_budget=None):
+        """Events per split of generate: batch_size, as many as fit in
+        memory_budget bytes, or nsplit equal splits"""
+        if memory_budget is not None:
+            batch_size = max(int(memory_budget//self.event_bytes()),1)
+        if batch_size is None:
+            return [len(split) for split in np.array_split(np.arange(nevts),nsplit) if len(split)]
+        return [min(batch_size,nevts - start) for start in range(0,nevts,batch_size)]
+
+    def evaluate_models(self,head,body,x,cond,mask_reco,time_cond):
+        body_cond, head_cond = cond
+        v = body([x,mask_reco] + time_cond + tf.nest.flatten(body_cond)[1:], training=False)
+        v = head([v,mask_reco] + tf.nest.flatten(head_cond),training=False)
         return mask_reco*v
 
+    def denoise(self,model,x,cond,time_cond,mask=None,pids=None):
+        """v-prediction of the EMA denoiser at the time encoded in time_cond"""
+        if mask is None:
+            return model([x] + time_cond + tf.nest.flatten(cond), training=False)
+        model_body, model_head = model
+        return self.evaluate_models(model_head,model_body,
+                                    tf.concat([x,pids],-1),
+                                    cond,mask,time_cond)
+
+    def get_time_cond(self,t,cond,mask=None):
+        """Inputs of the event (mask is None) or particle denoiser that depend on time"""
+        views = self.ema_views
+        if mask is None:
+            return [views.evt_time(t,training=False)]
+        cond_gen = tf.nest.flatten(cond[0])[0]
+        time_cond = views.body_modulation([views.body_time(t,training=False),cond_gen],
+                                          training=False)
+        return tf.nest.flatten(time_cond)
+
+    def get_time_tables(self,times,cond,mask=None):
+        """Time conditioning for all times of a sampler grid in one batched call.
+        Entries have shape (len(times),batch,...), batch is 1 when the entry
+        does not depend on the event. The particle tables take
+        len(times)*batch_size*num_layers*6*projection_dim floats."""
+        if mask is None:
+            return [c[:,None] for c in self.get_time_cond(times,cond)]
+
+        ntimes = tf.shape(times)[0]
+        cond_gen = tf.nest.flatten(cond[0])[0]
+        batch_size = tf.shape(cond_gen)[0]
+        time_embedding = tf.repeat(self.ema_views.body_time(times,training=False),batch_size,0)
+        time_cond = self.ema_views.body_modulation([time_embedding,
+                                                    tf.tile(cond_gen,[ntimes,1])],
+                                                   training=False)
+        return [tf.reshape(c,tf.concat([[ntimes,batch_size],tf.shape(c)[1:]],0))
+                for c in tf.nest.flatten(time_cond)]
+
+    def get_time_grid(self,num_steps):
+        """Times used by DDPMSampler from t=1 down: the step times t, the following
+        step t_ and the logsnr midpoint s, each with shape (num_steps,1)"""
+        time_step = tf.range(num_steps, 0, delta=-1)[:,None]
+        t = time_step/num_steps
+        t_ = (time_step - 1)/num_steps
+        s = inv_logsnr_schedule_cosine(0.5*(logsnr_schedule_cosine(t) + logsnr_schedule_cosine(t_)))
+        return t, t_, s
+
     @tf.function
     def second_order_correction(self,time_step,x,
                                 pred_images,pred_noises,
                                 alphas,sigmas, logsnr,
-                                cond_evt,cond_part,mask_cond,
+                                cond,
                                 model,
-                                evt=None,
                                 mask=None,
                                 pids = None,
                                 num_steps=100,
@@ -549,16 +949,11 @@ class PET(keras.Model):
         _, signal_rates, noise_rates = get_logsnr_alpha_sigma(t,shape=shape)
         noisy_images = signal_rates * pred_images + noise_rates * pred_noises
 
-        if evt is None:
-            v = model([noisy_images, cond_evt,cond_part,mask_cond,t],training=False)
-        else:
+        if mask is not None:
             noisy_images = noisy_images*mask
-            model_body, model_head = model
-            v = self.evaluate_models(model_head,model_body,
-                                     tf.concat([noisy_images,pids],-1),
-                                     cond_part,
-                                     mask,mask_cond,
-                                     evt,cond_evt,t)
+        v = self.denoise(model,noisy_images,cond,
+                         self.get_time_cond(t,cond,mask),
+                         mask,pids)
             
         pred_noises = noise_rates * noisy_images + signal_rates * v
         # linearly combine the two noise estimates
@@ -577,58 +972,64 @@ class PET(keras.Model):
 
     @tf.function
     def DDPMSampler(self,
-                    cond_part, mask_cond,cond_evt,                    
+                    cond,
                     model,
                     data_shape=None,
                     const_shape=None,
-                    evt=None,
                     num_steps = 100,
-                    mask=None,pids=None):
+                    mask=None,pids=None,
+                    time_tables=False):
         """Generate samples from score-based models with DDPM method.
         
         Args:
-        cond: Conditional input
-        model: Trained score model to use
+        cond: Cached outputs of the conditioning encoders
+        model: Denoiser, or [body, head] denoisers for particles, reading cond
         data_shape: Format of the data
         const_shape: Format for constants, should match the data_shape in dimensions
-        evt: input evt conditional information if used
         mask: particle mask if used
+        pids: one-hot particle ids, required together with mask
+        time_tables: precompute the time conditioning of all steps before sampling
 
         Returns: 
         Samples.
         """
 
-        batch_size = cond_evt.shape[0]
-        x = tf.random.normal(data_shape,dtype=tf.float32)
-
-        for time_step in tf.range(num_steps, 0, delta=-1):
-            t = tf.ones((batch_size, 1), dtype=tf.int32) * time_step / num_steps
-            logsnr, alpha, sigma = get_logsnr_alpha_sigma(t,shape=const_shape)
-            logsnr_, alpha_, sigma_ = get_logsnr_alpha_sigma(tf.ones((batch_size, 1), dtype=tf.int32) * (time_step - 1) / num_steps,shape=const_shape)
-            s = inv_logsnr_schedule_cosine(0.5*(logsnr + logsnr_))
-            logsnr_s, alpha_s, sigma_s = get_logsnr_alpha_sigma(s,shape=const_shape)
+        batch_size = data_shape[0]
+        x = tf.random.normal(data_shape,dtype=self.dtype)
+        mean = tf.zeros_like(x) #loop variable, defined for a dynamic batch size
+
+        time_grid, time_grid_, time_grid_s = self.get_time_grid(num_steps)
+        logsnrs, alphas, sigmas = get_logsnr_alpha_sigma(time_grid)
+        logsnrs_, alphas_, sigmas_ = get_logsnr_alpha_sigma(time_grid_)
+        logsnrs_s, alphas_s, sigmas_s = get_logsnr_alpha_sigma(time_grid_s)
+        if time_tables:
+            tables = self.get_time_tables(tf.concat([tf.cast(time_grid,tf.float32),time_grid_s],0),
+                                          cond,mask)
+
+        for step in tf.range(num_steps):
+            t = tf.ones((batch_size, 1), dtype=time_grid.dtype) * time_grid[step]
+            s = tf.ones((batch_size, 1), dtype=time_grid_s.dtype) * time_grid_s[step]
+            logsnr, alpha, sigma = [tf.reshape(c[step],const_shape) for c in (logsnrs, alphas, sigmas)]
+            logsnr_, alpha_, sigma_ = [tf.reshape(c[step],const_shape) for c in (logsnrs_, alphas_, sigmas_)]
+            logsnr_s, alpha_s, sigma_s = [tf.reshape(c[step],const_shape) for c in (logsnrs_s, alphas_s, sigmas_s)]
+            if time_tables:
+                time_cond = read_table(tables,step,batch_size)
+                time_cond_s = read_table(tables,num_steps + step,batch_size)
+            else:
+                time_cond = self.get_time_cond(t,cond,mask)
+                time_cond_s = self.get_time_cond(s,cond,mask)
 
             
-            if evt is None:
-                v = model([x,cond_evt,cond_part,mask_cond,t], training=False) 
-            else:
+            if mask is not None:
                 x = x*mask
-                model_body, model_head = model
-                v = self.evaluate_models(model_head,model_body,
-                                         tf.concat([x,pids],-1),
-                                         cond_part,
-                                         mask,mask_cond,
-                                         evt,cond_evt,t
-                                         )
+            v = self.denoise(model,x,cond,time_cond,mask,pids)
 
 
             # mean = alpha * x - sigma * v
             # eps = v * alpha + x * sigma
             # mean,eps = self.second_order_correction(t,x,mean,eps,
             #                                         alpha,sigma,logsnr,
-            #                                         cond_evt,cond_part,
-            #                                         mask_cond,
-            #                                         model,evt,mask,
+            #                                         cond,model,mask,
             #                                         num_steps=num_steps,
             #                                         shape=const_shape,
             #                                         pids = pids,
@@ -641,17 +1042,9 @@ class PET(keras.Model):
             u = alpha_s/alpha* x - sigma_s*tf.math.expm1(0.25*(logsnr_ - logsnr))*eps
 
 
-            if evt is None:
-                v = model([u,cond_evt,cond_part,mask_cond,s], training=False) 
-            else:
+            if mask is not None:
                 u = u*mask
-                model_body, model_head = model
-                v = self.evaluate_models(model_head,model_body,
-                                         tf.concat([u,pids],-1),
-                                         cond_part,
-                                         mask,mask_cond,
-                                         evt,cond_evt,s
-                                         )
+            v = self.denoise(model,u,cond,time_cond_s,mask,pids)
 
                 
             eps = v * alpha_s + u * sigma_s            
@@ -661,6 +1054,249 @@ class PET(keras.Model):
 
         return mean
 
+    @tf.function
+    def DDIMSampler(self,
+                    cond,
+                    model,
+                    data_shape=None,
+                    const_shape=None,
+                    num_steps = 100,
+                    mask=None,pids=None,
+                    time_tables=False):
+        """Deterministic DDIM sampler, one model evaluation per step.
+        Same arguments as DDPMSampler."""
+
+        batch_size = data_shape[0]
+        x = tf.random.normal(data_shape,dtype=self.dtype)
+        mean = tf.zeros_like(x) #loop variable, defined for a dynamic batch size
+
+        time_grid, time_grid_, _ = self.get_time_grid(num_steps)
+        _, alphas, sigmas = get_logsnr_alpha_sigma(time_grid)
+        _, alphas_, sigmas_ = get_logsnr_alpha_sigma(time_grid_)
+        if time_tables:
+            tables = self.get_time_tables(tf.cast(time_grid,tf.float32),cond,mask)
+
+        for step in tf.range(num_steps):
+            alpha, sigma = [tf.reshape(c[step],const_shape) for c in (alphas, sigmas)]
+            alpha_, sigma_ = [tf.reshape(c[step],const_shape) for c in (alphas_, sigmas_)]
+            if time_tables:
+                time_cond = read_table(tables,step,batch_size)
+            else:
+                t = tf.ones((batch_size, 1), dtype=time_grid.dtype) * time_grid[step]
+                time_cond = self.get_time_cond(t,cond,mask)
+
+            if mask is not None:
+                x = x*mask
+            v = self.denoise(model,x,cond,time_cond,mask,pids)
+
+            mean = alpha * x - sigma * v
+            eps = v * alpha + x * sigma
+            x = alpha_ * mean + sigma_ * eps
+
+        return mean
+
+    @tf.function
+    def DPMSampler(self,
+                   cond,
+                   model,
+                   data_shape=None,
+                   const_shape=None,
+                   num_steps = 100,
+                   mask=None,pids=None,
+                   time_tables=False):
+        """Multistep DPM-Solver++(2M) on the data prediction of the v-model,
+        https://arxiv.org/abs/2211.01095. One model evaluation per step, the
+        first and last steps are first order. Same arguments as DDPMSampler."""
+
+        batch_size = data_shape[0]
+        x = tf.random.normal(data_shape,dtype=self.dtype)
+        mean = tf.zeros_like(x) #loop variable, defined for a dynamic batch size
+
+        time_grid, time_grid_, _ = self.get_time_grid(num_steps)
+        logsnrs, alphas, sigmas = get_logsnr_alpha_sigma(time_grid)
+        logsnrs_, alphas_, sigmas_ = get_logsnr_alpha_sigma(time_grid_)
+        if time_tables:
+            tables = self.get_time_tables(tf.cast(time_grid,tf.float32),cond,mask)
+
+        mean_prev = tf.zeros_like(x)
+        h_prev = tf.ones_like(tf.reshape(logsnrs[0],const_shape))
+        for step in tf.range(num_steps):
+            logsnr, alpha, sigma = [tf.reshape(c[step],const_shape) for c in (logsnrs, alphas, sigmas)]
+            logsnr_, alpha_, sigma_ = [tf.reshape(c[step],const_shape) for c in (logsnrs_, alphas_, sigmas_)]
+            if time_tables:
+                time_cond = read_table(tables,step,batch_size)
+            else:
+                t = tf.ones((batch_size, 1), dtype=time_grid.dtype) * time_grid[step]
+                time_cond = self.get_time_cond(t,cond,mask)
+
+            if mask is not None:
+                x = x*mask
+            v = self.denoise(model,x,cond,time_cond,mask,pids)
+            mean = alpha * x - sigma * v
+
+            #Step size in lambda = log(alpha/sigma) = logsnr/2
+            h = 0.5*(logsnr_ - logsnr)
+            if step == 0 or step == num_steps - 1:
+                data = mean
+            else:
+                r = h_prev/h
+                data = (1. + 0.5/r)*mean - 0.5/r*mean_prev
+            x = sigma_/sigma * x - alpha_ * tf.math.expm1(-h) * data
+            mean_prev = mean
+            h_prev = h
+
+        return mean
+
+
+class PETDistill(PET):
+    """Progressive distillation student, https://arxiv.org/abs/2202.00512.
+    One DDIM step of the student on a grid of num_steps (particles) and
+    num_steps_evt (events) matches two steps of the teacher sampler, DDPM for
+    the trained PET and DDIM for a distilled teacher. A component with as
+    many steps as its teacher matches the teacher prediction instead."""
+    timed_components = ['teacher'] + PET.timed_components
+
+    def __init__(self,teacher,evt_steps,part_steps,teacher_sampler='ddpm',**kwargs):
+        super(PETDistill, self).__init__(**kwargs)
+        self.num_steps_evt = evt_steps
+        self.num_steps = part_steps
+        self.teacher_sampler = teacher_sampler
+        self.set_teacher(teacher)
+
+        #Student starts from the teacher EMA weights
+        for student, ema, source in [(self.body,self.ema_body,teacher.ema_body),
+                                     (self.generator_head,self.ema_head,teacher.ema_head),
+                                     (self.model_evt,self.ema_evt,teacher.ema_evt)]:
+            student.set_weights(source.get_weights())
+            ema.set_weights(source.get_weights())
+
+    @tf.__internal__.tracking.no_automatic_dependency_tracking
+    def set_teacher(self,teacher):
+        #Not tracked, so the student checkpoint loads into a plain PET
+        self.teacher = teacher
+
+    def teacher_step(self,model,z,cond,t,t_next,mask=None,pids=None,const_shape=None):
+        teacher = self.teacher
+        logsnr, alpha, sigma = get_logsnr_alpha_sigma(t,shape=const_shape)
+        logsnr_, alpha_, sigma_ = get_logsnr_alpha_sigma(t_next,shape=const_shape)
+
+        if mask is not None:
+            z = z*mask
+        v = teacher.denoise(model,z,cond,teacher.get_time_cond(t,cond,mask),mask,pids)
+        eps = v * alpha + z * sigma
+        if self.teacher_sampler == 'ddim':
+            mean = alpha * z - sigma * v
+            return alpha_ * mean + sigma_ * eps
+
+        #Midpoint update of DDPMSampler
+        s = inv_logsnr_schedule_cosine(0.5*(logsnr_schedule_cosine(t) + logsnr_schedule_cosine(t_next)))
+        logsnr_s, alpha_s, sigma_s = get_logsnr_alpha_sigma(s,shape=const_shape)
+        u = alpha_s/alpha* z - sigma_s*tf.math.expm1(0.25*(logsnr_ - logsnr))*eps
+        if mask is not None:
+            u = u*mask
+        v = teacher.denoise(model,u,cond,teacher.get_time_cond(s,cond,mask),mask,pids)
+        eps = v * alpha_s + u * sigma_s
+        mean = alpha_s * u - sigma_s * v
+        return alpha_ * mean + sigma_ * eps
+
+    def get_target(self,model,x,cond,num_steps,teacher_steps,mask=None,pids=None):
+        """Noisy inputs z at student grid times t and the v target of the student"""
+        batch_size = tf.shape(x)[0]
+        const_shape = (-1,) + (1,)*(len(x.shape) - 1)
+        step = tf.random.uniform((batch_size,1),1,num_steps + 1,dtype=tf.int32)
+        t = tf.cast(step/num_steps,tf.float32)
+        
+        eps = tf.random.normal(tf.shape(x),dtype=x.dtype)
+        if mask is not None:
+            eps = eps*mask
+        _, alpha, sigma = get_logsnr_alpha_sigma(t,shape=const_shape)
+        z = alpha * x + sigma * eps
+
+        if teacher_steps == num_steps:
+            v = self.teacher.denoise(model,z,cond,self.teacher.get_time_cond(t,cond,mask),mask,pids)
+            return t, z, v
+
+        assert teacher_steps == 2*num_steps, 'ERROR: student must take half the steps of the teacher'
+        t_mid = tf.cast((2*step - 1)/(2*num_steps),tf.float32)
+        t_next = tf.cast((step - 1)/num_steps,tf.float32)
+        z_next = self.teacher_step(model,z,cond,t,t_mid,mask,pids,const_shape)
+        z_next = self.teacher_step(model,z_next,cond,t_mid,t_next,mask,pids,const_shape)
+
+        #Student x prediction that lands on z_next with a single DDIM step
+        _, alpha_, sigma_ = get_logsnr_alpha_sigma(t_next,shape=const_shape)
+        ratio = sigma_/sigma
+        x_target = (z_next - ratio*z)/(alpha_ - ratio*alpha)
+        v = (alpha * z - x_target)/sigma
+        if mask is not None:
+            v = v*mask
+        return t, z, v
+
+    def get_targets(self,inputs):
+        teacher = self.teacher.ema_views
+        gen_mask = inputs['input_gen_mask'][:,:,None]
+        
+        teacher_knn = self.teacher.knn_inputs(inputs)
+        part_cond = [teacher.body_encoder([inputs['input_gen'],gen_mask,inputs['input_gen_evt']] + teacher_knn,
+                                          training=False),
+                     teacher.head_encoder([inputs['input_gen'],gen_mask] + teacher_knn,training=False)]
+        part_target = self.get_target([teacher.body_denoiser,teacher.head_denoiser],
+                                      inputs['input_reco'][:,:,:self.num_diffusion],
+                                      part_cond,self.num_steps,self.teacher.num_steps,
+                                      mask=inputs['input_reco_mask'][:,:,None],
+                                      pids=inputs['input_reco'][:,:,self.num_diffusion:])
+
+        evt_cond = teacher.evt_encoder([inputs['input_gen_evt'],inputs['input_gen'],gen_mask] + teacher_knn,
+                                       training=False)
+        evt_target = self.get_target(teacher.evt_denoiser,inputs['input_reco_evt'],
+                                     evt_cond,self.num_steps_evt,self.teacher.num_steps_evt)
+        return tf.nest.map_structure(tf.stop_gradient,(part_target,evt_target))
+
+    def get_losses(self,inputs,targets):
+        return self.get_loss_part(inputs,targets), self.get_loss_evt(inputs,targets)
+
+    def get_loss_part(self,inputs,targets):
+        (t_part, z_part, v_part), _ = targets
+        v_pred_part = self.generator([tf.concat([z_part,inputs['input_reco'][:,:,self.num_diffusion:]],-1),
+                                      inputs['input_gen'],
+                                      inputs['input_reco_mask'],inputs['input_gen_mask'],
+                                      inputs['input_reco_evt'],inputs['input_gen_evt'],t_part]
+                                     + self.knn_inputs(inputs))
+        return tf.reduce_sum(tf.square(v_part-v_pred_part))/(tf.reduce_sum(inputs['input_reco_mask']))
+
+    def get_loss_evt(self,inputs,targets):
+        _, (t_evt, z_evt, v_evt) = targets
+        v_pred = self.model_evt([z_evt,
+                                 inputs['input_gen_evt'],
+                                 inputs['input_gen'],
+                                 inputs['input_gen_mask'],
+                                 t_evt] + self.knn_inputs(inputs))
+        return tf.reduce_mean(tf.square(v_pred-v_evt))
+
+    def train_step(self, inputs):
+        self.start_timer(inputs)
+        with self.timed('teacher'):
+            targets = self.get_targets(inputs)
+        with tf.GradientTape() as tape_part, self.timed('generator_forward'):
+            loss_part = self.get_loss_part(inputs,targets)
+        with tf.GradientTape() as tape_evt, self.timed('evt_forward'):
+            loss_evt = self.get_loss_evt(inputs,targets)
+        loss = loss_evt + loss_part
+
+        trainable_vars = self.model_evt.trainable_variables + self.generator_head.trainable_variables
+        self.apply_updates(tape_part,tape_evt,loss_part,loss_evt,self.body.trainable_variables,trainable_vars)
+
+        self.loss_tracker.update_state(loss)
+        self.loss_part_tracker.update_state(loss_part)
+        self.loss_evt_tracker.update_state(loss_evt)
+        return {m.name: m.result() for m in self.metrics}
+
+    def test_step(self, inputs):
+        loss_part, loss_evt = self.get_losses(inputs,self.get_targets(inputs))
+        self.loss_tracker.update_state(loss_evt + loss_part)
+        self.loss_part_tracker.update_state(loss_part)
+        self.loss_evt_tracker.update_state(loss_evt)
+        return {m.name: m.result() for m in self.metrics}
+
 
 class PETCorrector(keras.Model):
     """Point-Edge Transformer"""
@@ -752,8 +1388,16 @@ class PETCorrector(keras.Model):
             loss = getSWD(corrected,inputs['input_label'])
             
             
-        self.body_optimizer.minimize(loss,self.body.trainable_variables,tape=tape)
-        self.optimizer.minimize(loss,self.corrector_head.trainable_variables,tape=tape)
+        body_vars = self.body.trainable_variables
+        head_vars = self.corrector_head.trainable_variables
+        grads = (get_gradients(self.body_optimizer,tape,loss,body_vars)
+                 + get_gradients(self.optimizer,tape,loss,head_vars))
+        update = lambda grads: apply_gradients([self.body_optimizer,self.optimizer],grads,[body_vars,head_vars],
+                                               self.allreduce)
+        if self.accumulator is None:
+            update(grads)
+        else:
+            self.accumulator(grads,update)
         
         self.loss_tracker.update_state(loss)
         return {m.name: m.result() for m in self.metrics}
@@ -784,31 +1428,31 @@ class PETCorrector(keras.Model):
 
         encoded = get_encoding(input_reco,self.projection_dim)
         gen_encoded = get_encoding(input_gen,self.projection_dim)
-        gen_encoded = layers.GroupNormalization(groups=1)(gen_encoded)*input_gen_mask
+        reco_mask = cast(input_reco_mask,compute_dtype())
+        gen_encoded = layers.GroupNormalization(groups=1)(gen_encoded)*cast(input_gen_mask,compute_dtype())
                 
         #Local info
         
-        coord_shift_reco = tf.multiply(999., tf.cast(tf.equal(input_reco_mask, 0), dtype='float32'))
-        coord_shift_gen = tf.multiply(999., tf.cast(tf.equal(input_gen_mask, 0), dtype='float32'))
         points_reco = input_reco
         points_gen = input_gen
         local_features = input_reco
         local_gens = input_gen
         
         for _ in range(self.num_local):    
-            local_features = get_neighbors(coord_shift_reco + points_reco,
-                                           #tf.concat([coord_shift_gen + points_gen,coord_shift_reco + points_reco],1),
-                                           coord_shift_gen + points_gen,
+            local_features = get_neighbors(points_reco,
+                                           #tf.concat([points_gen,points_reco],1),
+                                           points_gen,
                                            local_features,
                                            local_gens,
                                            #tf.concat([local_gens,local_features],1),
-                                           self.projection_dim,K)
+                                           self.projection_dim,K,
+                                           input_reco_mask,input_gen_mask)
             local_gens = layers.Dense(self.projection_dim,activation="gelu")(local_gens)
             points_reco = local_features
             points_gen = local_gens
             
             
-        encoded = layers.Add()([local_features,encoded])*input_reco_mask
+        encoded = layers.Add()([local_features,encoded])*reco_mask
 
         skip_connection = encoded
         for i in range(self.num_layers):
@@ -827,18 +1471,24 @@ class PETCorrector(keras.Model):
             x3 = layers.Dense(self.projection_dim)(x3)
             x3 = LayerScale(self.layer_scale_init, self.projection_dim)(x3,input_reco_mask)
 
-            encoded = layers.Add()([x3,x2])*input_reco_mask
+            encoded = layers.Add()([x3,x2])*reco_mask
                        
         return encoded + skip_connection
 
 
-    def compile(self,body_optimizer,head_optimizer):
+    def compile(self,body_optimizer,head_optimizer,jit_compile=False,accum_steps=1,allreduce=None):
         super(PETCorrector, self).compile(experimental_run_tf_function=False,
                                   weighted_metrics=[],
+                                  jit_compile=jit_compile,
                                   #run_eagerly=True
                                   )
-        self.body_optimizer = body_optimizer
-        self.optimizer = head_optimizer
+        self.body_optimizer = loss_scale(body_optimizer)
+        self.optimizer = loss_scale(head_optimizer)
+        self.allreduce = allreduce
+        self.accumulator = None
+        if accum_steps > 1:
+            self.accumulator = GradientAccumulator(
+                self.body.trainable_variables + self.corrector_head.trainable_variables,accum_steps)
 
 
     def PET_corrector(
@@ -851,53 +1501,341 @@ class PETCorrector(keras.Model):
     ):
 
 
-        coord_shift_reco = tf.multiply(999., tf.cast(tf.equal(input_reco_mask, 0), dtype='float32'))
-        coord_shift_gen = tf.multiply(999., tf.cast(tf.equal(input_gen_mask, 0), dtype='float32'))
-
-        gen_embedding = get_encoding(input_gen,self.projection_dim)*input_gen_mask
+        gen_embedding = get_encoding(input_gen,self.projection_dim)*cast(input_gen_mask,compute_dtype())
         # gen_embedding = tf.reduce_mean(gen_embedding,1)
         # encoded = encoded + gen_embedding[:,None]
 
         
-        encoded = get_neighbors(coord_shift_reco + encoded,
-                                coord_shift_gen + gen_embedding,
+        encoded = get_neighbors(encoded,
+                                gen_embedding,
                                 encoded,gen_embedding,
-                                self.projection_dim,K)
+                                self.projection_dim,K,
+                                input_reco_mask,input_gen_mask)
 
-        encoded = layers.Dense(2*self.num_correct)(encoded)*input_reco_mask
+        encoded = cast(layers.Dense(2*self.num_correct)(encoded),'float32')*input_reco_mask
         return encoded
 
 
     
 
+#Samplers accepted by PET.generate
+SAMPLERS = {'ddpm':'DDPMSampler','ddim':'DDIMSampler','dpm':'DPMSampler'}
+
+class SamplerViews:
+    """Plain container for the sampling sub-models. Not tracked by Keras, so
+    the checkpoint layout of PET is unchanged."""
+    def __init__(self,**views):
+        self.__dict__.update(views)
+
+class SamplerCalls:
+    """Event and particle entry points of a PET sampler method. The input
+    signature, taken from the first call with all but the feature dimension
+    left free, and the number of steps passed as a tensor, trace each entry
+    point once per time_tables setting instead of once per batch size,
+    particle length and step count. Not tracked by Keras."""
+    def __init__(self,model,sample_fn,jit_compile=False):
+        self.model = model
+        self.sample_fn = sample_fn.python_function
+        self.jit_compile = jit_compile
+        self.calls = {}
+
+    def events(self,cond,num_steps,time_tables=False):
+        return self.call(self.sample_events,time_tables,num_steps,cond)
+
+    def particles(self,cond,mask,pids,num_steps,time_tables=False):
+        return self.call(self.sample_particles,time_tables,num_steps,cond,mask,pids)
+
+    def call(self,fn,time_tables,num_steps,*inputs):
+        inputs = tf.nest.map_structure(tf.convert_to_tensor,inputs)
+        key = (fn.__name__,time_tables)
+        if key not in self.calls:
+            signature = tf.nest.map_structure(lambda x: tf.TensorSpec([None]*(x.shape.rank - 1) + x.shape[-1:],
+                                                                        x.dtype),inputs)
+            self.calls[key] = tf.function(lambda inputs,num_steps: fn(*inputs,num_steps,time_tables),
+                                          input_signature=[signature,tf.TensorSpec([],tf.int32)],
+                                          jit_compile=self.jit_compile)
+        return self.calls[key](inputs,tf.constant(num_steps,tf.int32))
+
+    def sample_events(self,cond,num_steps,time_tables):
+        batch_size = tf.shape(tf.nest.flatten(cond)[0])[0]
+        return self.sample_fn(cond,self.model.ema_views.evt_denoiser,
+                              data_shape=[batch_size,self.model.num_evt],
+                              num_steps=num_steps,const_shape=[-1,1],
+                              time_tables=time_tables)
+
+    def sample_particles(self,cond,mask,pids,num_steps,time_tables):
+        views = self.model.ema_views
+        return self.sample_fn(cond,[views.body_denoiser,views.head_denoiser],
+                              data_shape=[tf.shape(mask)[0],tf.shape(mask)[1],self.model.num_diffusion],
+                              num_steps=num_steps,const_shape=self.model.shape,
+                              mask=mask,pids=pids,time_tables=time_tables)
+
+class EMAWeights(keras.Model):
+    """Container of the EMA models for save_weights and load_weights"""
+    def __init__(self,ema_evt,ema_body,ema_head):
+        super(EMAWeights, self).__init__()
+        self.ema_evt = ema_evt
+        self.ema_body = ema_body
+        self.ema_head = ema_head
+        self.built = True
+
+class StepTimer:
+    """Host wall time of the train_step components, and the number of steps,
+    events and particles, summed in variables until read. Each timed component
+    waits for the previous one, so the components no longer overlap. On GPU
+    the timestamps follow the kernel launches, use a tf.profiler capture for
+    device times. Not tracked by Keras."""
+    def __init__(self,components):
+        self.totals = {name: tf.Variable(0.0,dtype=tf.float64,trainable=False)
+                       for name in ['steps','events','particles'] + components}
+        self.last = tf.Variable(0.0,dtype=tf.float64,trainable=False)
+
+    def start(self,events,particles):
+        self.totals['steps'].assign_add(1.0)
+        self.totals['events'].assign_add(tf.cast(events,tf.float64))
+        self.totals['particles'].assign_add(tf.cast(particles,tf.float64))
+        self.last.assign(tf.timestamp())
+
+    @contextlib.contextmanager
+    def time(self,component):
+        graph = tf.compat.v1.get_default_graph()
+        first = len(graph.get_operations())
+        with tf.control_dependencies([self.last.read_value()]):
+            yield
+        #Timestamp after all ops of the component
+        with tf.control_dependencies(graph.get_operations()[first:]):
+            now = tf.timestamp()
+        self.totals[component].assign_add(now - self.last)
+        self.last.assign(now)
+
+    def read(self):
+        """Totals since the last read, resets them"""
+        totals = {name: float(total.numpy()) for name, total in self.totals.items()}
+        for total in self.totals.values():
+            total.assign(0.0)
+        return totals
+
+class WeightEMA:
+    """Exponential moving average of weights into shadow variables, updated
+    every interval steps with the decay raised to the power interval, so the
+    averaging horizon in steps is unchanged. The update of all variables is a
+    single XLA function, fused into a few kernels instead of several small ops
+    per variable. Not tracked by Keras."""
+    def __init__(self,weights,shadows,decay,interval=1,device=None):
+        self.weights = weights
+        self.shadows = shadows
+        self.decay = decay**interval
+        self.interval = interval
+        self.device = device
+        self.fused_update = tf.function(self.update_shadows,jit_compile=True)
+
+    def __call__(self,step):
+        if self.interval == 1:
+            self.update()
+        else:
+            tf.cond(step % self.interval == 0, self.update, lambda: None)
+
+    def update(self):
+        #XLA functions run on a single device, the weights are copied to the
+        #device of the shadows when it is different
+        weights = self.weights if self.device is None else [tf.convert_to_tensor(w) for w in self.weights]
+        with tf.device(self.device):
+            self.fused_update(weights)
+
+    def update_shadows(self,weights):
+        for weight, shadow in zip(weights,self.shadows):
+            shadow.assign(self.decay * shadow + (1 - self.decay) * weight)
+
+def get_view(clone,model_inputs,inputs,outputs):
+    """Sub-model of clone, a copy made with clone_model of a model built from
+    model_inputs, between the clone tensors matching inputs and outputs of the
+    original graph. Inputs may be intermediate tensors, cutting the graph there."""
+    def find(tensor):
+        for x,x_clone in zip(model_inputs,clone.inputs):
+            if x is tensor:
+                return x_clone
+        layer, node_index, tensor_index = tensor._keras_history
+        node = clone.get_layer(layer.name).inbound_nodes[node_index]
+        return tf.nest.flatten(node.outputs)[tensor_index]
+    return keras.Model(inputs=[find(x) for x in inputs],
+                       outputs=[find(x) for x in outputs])
+
+def cross_attention(query,key,value,key_mask,num_heads,projection_dim):
+    """Multi-head attention of the query tokens to already projected keys and
+    values (B,N,projection_dim). Padded keys, key_mask (B,N,1) of zero, are
+    ignored."""
+    head_dim = projection_dim//num_heads
+    def heads(x):
+        #(B,N,projection_dim) to (B,num_heads,N,head_dim)
+        return tf.transpose(layers.Reshape((-1,num_heads,head_dim))(x),[0,2,1,3])
+    query = heads(layers.Dense(projection_dim)(query))
+    logits = tf.matmul(query,heads(key),transpose_b=True)/np.sqrt(head_dim)
+    attention = layers.Softmax(axis=-1,dtype='float32')(logits,tf.transpose(key_mask,[0,2,1])[:,None] > 0)
+    updates = tf.matmul(cast(attention,query.dtype),heads(value))
+    updates = layers.Reshape((-1,projection_dim))(tf.transpose(updates,[0,2,1,3]))
+    return layers.Dense(projection_dim,kernel_initializer='zeros')(updates)
+
+def pack_tokens(reco,gen,reco_mask,gen_mask,block=None):
+    """Reco and gen tokens of the body attention with their token mask and the
+    number of reco tokens. With block, trailing blocks of block gen slots padded
+    in every event are dropped, so the attention cost follows the largest
+    multiplicity of the batch rather than the padded length. The reco tokens
+    are trimmed at the inputs of the body. Particles are expected first and
+    padding last."""
+    if block:
+        gen_mask = trim_padding(gen_mask,gen_mask,block)[1]
+    return SlotConcat()([reco,gen],[reco_mask,gen_mask]), tf.concat([reco_mask,gen_mask],1), tf.shape(reco)[1]
+
+def trim_padding(x,mask,block):
+    num_part = tf.cast(tf.reduce_max(tf.reduce_sum(mask,[1,2])),tf.int32)
+    size = tf.minimum((num_part + block - 1)//block*block,tf.shape(x)[1])
+    size = tf.maximum(size,1)
+    return x[:,:size], mask[:,:size]
+
+def read_table(tables,index,batch_size):
+    """Row index of the time tables, broadcast to the batch"""
+    return [tf.broadcast_to(c[index],tf.concat([[batch_size],tf.shape(c)[2:]],0))
+            for c in tables]
+
 def get_neighbors(points_reco,points_gen,
                   features_reco,features_gen,
-                  projection_dim,K,reduce='max'):
-    drij = pairwise_distance(points_reco,points_gen)  # (N, P, P)
-    _, indices = tf.nn.top_k(-drij, k=K)  # (N, P, K+1)
-    #indices = indices[:, :, 1:]  # (N, P, K)
-        
-    knn_fts = knn(tf.shape(points_reco)[1], K, indices, features_gen)  # (N, P, K, C)
-    knn_fts_center = tf.broadcast_to(tf.expand_dims(features_reco, 2), tf.shape(knn_fts))
-    local = tf.concat([knn_fts-knn_fts_center,knn_fts_center],-1)
-    local = layers.Dense(4*projection_dim,activation='gelu')(local)
-    local = layers.Dense(projection_dim,activation='gelu')(local)
+                  projection_dim,K,mask_reco,mask_gen,
+                  reduce='max',block_size=256,indices=None,recompute=False):
+    #Real particles see the real neighbors first, then the nearest padded slots.
+    #Precomputed indices skip the search. With recompute, the (N, P, K) activations
+    #of the Dense layers are recomputed in the backward pass
+    checkpoint = recomputed if recompute else (lambda layer: layer)
+    local = NeighborFeatures(K,block_size)(points_gen,points_reco,
+                                           features_gen,features_reco,
+                                           mask_gen,mask_reco,indices=indices)  # (N, P, K, 2C)
+    local = checkpoint(layers.Dense(4*projection_dim,activation='gelu'))(local)
+    local = checkpoint(layers.Dense(projection_dim,activation='gelu'))(local)
     if reduce == 'max':
         local = tf.reduce_max(local,-2)
     else:
         local = tf.reduce_mean(local,-2)
     return local
 
+def loss_scale(optimizer):
+    """Dynamic loss scaling for float16 compute. get_gradients scales the
+    loss and unscales the gradients, apply_gradients skips steps with
+    overflows. bfloat16 has the float32 exponent range and needs no scaling."""
+    if compute_dtype() == 'float16' and not isinstance(optimizer,keras.mixed_precision.LossScaleOptimizer):
+        return keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+def get_gradients(optimizer,tape,loss,variables):
+    """Local gradients of loss, with the loss scaling of optimizer.minimize
+    under float16. One backward pass, also for variables listed more than once"""
+    if isinstance(optimizer,keras.mixed_precision.LossScaleOptimizer):
+        grads = tape.gradient(loss,variables,
+                              output_gradients=optimizer.get_scaled_loss(tf.ones_like(loss)))
+        return optimizer.get_unscaled_gradients(grads)
+    return tape.gradient(loss,variables)
+
+class GradientAllreduce:
+    """Horovod average of the gradients over workers, which hvd.DistributedOptimizer
+    only does inside minimize. The gradients are divided by predivide before the
+    sum and by size/predivide after it, compression='fp16' sends them as float16
+    and fused=True reduces them in a single grouped allreduce instead of one per
+    tensor. Positional, the duplicates of shared variables are reduced separately.
+    Not tracked by Keras."""
+    def __init__(self,compression='none',predivide=1.0,fused=False):
+        self.compression = hvd.Compression.fp16 if compression == 'fp16' else hvd.Compression.none
+        self.predivide = predivide
+        self.fused = fused
+
+    def __call__(self,grads):
+        if hvd.size() == 1:
+            return grads
+        #IndexedSlices of gathers are reduced as dense tensors
+        dense = [tf.convert_to_tensor(grad) for grad in grads if grad is not None]
+        kwargs = dict(op=hvd.Average,prescale_factor=1.0/self.predivide,
+                      postscale_factor=self.predivide,compression=self.compression)
+        if self.fused:
+            reduced = iter(hvd.grouped_allreduce(dense,**kwargs))
+        else:
+            reduced = iter([hvd.allreduce(grad,**kwargs) for grad in dense])
+        return [next(reduced) if grad is not None else None for grad in grads]
+
+def apply_gradients(optimizers,grads,var_lists,allreduce=None):
+    """Update of each optimizer with its slice of the grads, averaged over the
+    workers by allreduce. Multi-worker training needs allreduce"""
+    if allreduce is not None:
+        grads = allreduce(grads)
+    elif hvd.is_initialized() and hvd.size() > 1:
+        raise ValueError(f'ERROR: training on {hvd.size()} ranks without a gradient allreduce, compile with allreduce=GradientAllreduce()')
+    for optimizer, variables in zip(optimizers,var_lists):
+        opt_grads, grads = grads[:len(variables)], grads[len(variables):]
+        optimizer.apply_gradients(zip(opt_grads,variables))
+
+class GradientAccumulator:
+    """Sums the gradients of accum_steps batches and calls update with their
+    mean on every accum_steps-th call, so the Horovod average and the
+    optimizer step run once per accumulated step. Not tracked by Keras."""
+    def __init__(self,variables,accum_steps):
+        self.accum_steps = accum_steps
+        self.step = tf.Variable(0,dtype=tf.int64,trainable=False)
+        self.sums = [tf.Variable(tf.zeros_like(var),trainable=False) for var in variables]
+
+    def __call__(self,grads,update):
+        #grads in the order of variables, the duplicates of shared variables
+        #in the head list are summed into their own accumulators
+        for total, grad in zip(self.sums,grads):
+            if grad is not None:
+                total.assign_add(tf.convert_to_tensor(grad))
+        self.step.assign_add(1)
+
+        def step():
+            update([None if grad is None else total/self.accum_steps
+                    for total, grad in zip(self.sums,grads)])
+            for total in self.sums:
+                total.assign(tf.zeros_like(total))
+        tf.cond(self.step % self.accum_steps == 0, step, lambda: None)
+
+def add_gradients(grad1,grad2):
+    #Sum of two gradients of the same variable, None if not connected
+    if grad1 is None or grad2 is None:
+        return grad2 if grad1 is None else grad1
+    return grad1 + grad2
+
+def compute_dtype():
+    #Activation dtype of the global Keras mixed precision policy
+    return keras.mixed_precision.global_policy().compute_dtype
+
+def cast(x,dtype):
+    #Skip the cast, and the extra graph node, when x already has dtype
+    return x if x.dtype == dtype else tf.cast(x,dtype)
+
+def pad_batch(x,batch_size):
+    #Pad with copies of the last event, so padded events stay valid inputs
+    return np.pad(x,[(0,batch_size - x.shape[0])] + [(0,0)]*(x.ndim - 1),mode='edge')
+
+def bucket_size(size,largest):
+    #Padded size of a split: the largest split, or the next power of two for
+    #a short last split
+    if 2*size > largest:
+        return largest
+    return 1 << (size - 1).bit_length()
+
 def make_pid(npids,max_part):
-    onehot = np.zeros((npids.shape[0],max_part,npids.shape[-1]),dtype=np.float32)
-    num_part_init = np.zeros(npids.shape[0],dtype=int)
-    for i in range(npids.shape[-1]):    
-        num_part_end = num_part_init + npids[:,i].astype(int)
-        for j in range(npids.shape[0]):
-            onehot[j, num_part_init[j]:num_part_end[j],i] = 1
-        num_part_init = num_part_end
-    return onehot
-        
+    #One-hot pid of each slot, class i fills the slots between the running
+    #counts of classes <i and <=i. The bounds are normalized like the Python
+    #slices of the former per-event loop, which negative counts can reach
+    ends = np.cumsum(npids.astype(int),-1)
+    starts = ends - npids.astype(int)
+    starts, ends = [np.clip(np.where(x < 0,x + max_part,x),0,max_part)[:,None].astype(np.int32)
+                    for x in (starts,ends)]
+    with tf.device('/CPU:0'):
+        return pid_slots(starts,ends,max_part).numpy()
+
+@tf.function(jit_compile=True,reduce_retracing=True)
+def pid_slots(starts,ends,max_part):
+    #XLA fuses the compares and the cast in one pass over the (N,P,C) output,
+    #NumPy broadcasting over the few pid classes is several times slower
+    slots = tf.range(max_part)[None,:,None]
+    return tf.cast((slots >= starts) & (slots < ends),tf.float32)
+
 def pairwise_distance(point_cloud1,point_cloud2):
     r_A = tf.reduce_sum(point_cloud1 * point_cloud1, axis=2, keepdims=True)
     r_B = tf.reduce_sum(point_cloud2 * point_cloud2, axis=2, keepdims=True) 
@@ -943,6 +1881,8 @@ def logsnr_schedule_cosine(t, logsnr_min=-20., logsnr_max=20.):
     return -2. * tf.math.log(tf.math.tan(a * tf.cast(t,tf.float32) + b))
     
 def get_logsnr_alpha_sigma(time,shape=None):
+    #The schedule stays in float32 under mixed precision: in bfloat16 the
+    #times of neighboring sampler steps near t=1 are not distinguishable
     logsnr = logsnr_schedule_cosine(time)
     alpha = tf.sqrt(tf.math.sigmoid(logsnr))
     sigma = tf.sqrt(tf.math.sigmoid(-logsnr))
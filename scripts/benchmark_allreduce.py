@@ -0,0 +1,100 @@
+"""Horovod allreduce of the PET gradients.
+
+Averages gradients with the shapes of the PET body and head variables over
+the workers: once per optimizer (body and head separately), in a single
+fused allreduce of both, and fused with fp16 compression. Runs on one
+machine with a multi-process gloo launch, e.g.
+
+    horovodrun -np 4 -H localhost:4 --gloo python benchmark_allreduce.py --projection 64 128
+
+The gradient size of each model is the tensor fusion buffer needed by the
+fused allreduce (horovodrun --fusion-threshold-mb, train.py --fusion_threshold).
+The error is the largest deviation from the uncompressed average relative
+to the largest averaged gradient.
+"""
+import time
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+import horovod.tensorflow as hvd
+
+from PET import PET, GradientAllreduce
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the Horovod gradient allreduce.")
+    parser.add_argument("--projection", type=int, nargs='+', default=[64, 128], help="Base projection sizes")
+    parser.add_argument("--num_layers", type=int, default=6, help="Number of transformer layers")
+    parser.add_argument("--num_local", type=int, default=1, help="Number of local layers")
+    parser.add_argument("--predivide", type=float, default=1.0, help="Gradient predivide factor of the fp16 allreduce")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of timed allreduces")
+    parser.add_argument("--gpu", action='store_true', default=False, help="Keep the GPUs visible")
+    parser.add_argument("--output", default=None, help="Optional JSON file to store the results")
+    return parser.parse_args()
+
+
+def get_methods(body_vars, predivide):
+    separate = GradientAllreduce()
+    fused = GradientAllreduce(fused=True)
+    fp16 = GradientAllreduce('fp16', predivide, fused=True)
+    nbody = len(body_vars)
+    return {
+        'separate': lambda grads: separate(grads[:nbody]) + separate(grads[nbody:]),
+        'fused': fused,
+        'fused_fp16': fp16,
+    }
+
+
+def measure(fn, grads, repeat):
+    out = fn(grads)  # trace
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn(grads)
+    out = [o.numpy() for o in out]
+    return (time.perf_counter() - start)/repeat, out
+
+
+def main():
+    flags = parse_arguments()
+    if not flags.gpu:
+        tf.config.set_visible_devices([], 'GPU')
+    hvd.init()
+    rng = np.random.default_rng(hvd.rank())
+
+    results = []
+    for projection in flags.projection:
+        model = PET(num_feat=13, num_evt=8, num_part=50, projection_dim=projection,
+                    num_layers=flags.num_layers, num_local=flags.num_local)
+        #Variable lists of PET.train_step, the head list repeats the shared variables
+        body_vars = model.body.trainable_variables
+        head_vars = model.model_evt.trainable_variables + model.generator_head.trainable_variables
+        grads = [tf.constant(1e-3*rng.standard_normal(var.shape), dtype=var.dtype)
+                 for var in body_vars + head_vars]
+        grad_bytes = sum(grad.numpy().nbytes for grad in grads)
+
+        reference = None
+        for name, fn in get_methods(body_vars, flags.predivide).items():
+            elapsed, out = measure(tf.function(fn), grads, flags.repeat)
+            if reference is None:
+                reference = out
+            scale = max(np.abs(r).max() for r in reference)
+            error = max(np.abs(o - r).max() for o, r in zip(out, reference))/scale
+            results.append({'method': name, 'projection': projection, 'variables': len(grads),
+                            'grad_bytes': grad_bytes//2 if 'fp16' in name else grad_bytes,
+                            'time': elapsed, 'error': float(error), 'ranks': hvd.size()})
+
+    if hvd.rank() != 0:
+        return
+    print(f"{'method':<12}{'proj':>6}{'vars':>6}{'grads [MiB]':>13}{'time [ms]':>12}{'error':>10}")
+    for stats in results:
+        print(f"{stats['method']:<12}{stats['projection']:>6}{stats['variables']:>6}"
+              f"{stats['grad_bytes']/2**20:>13.2f}{1e3*stats['time']:>12.2f}{stats['error']:>10.1e}")
+
+    if flags.output is not None:
+        with open(flags.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
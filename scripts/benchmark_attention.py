@@ -0,0 +1,126 @@
+"""Scaling of the attention blocks with the number of particles.
+
+Times the full self-attention used in the PET body (MultiHeadAttention),
+the TalkingHeadAttention and SimpleHeadAttention layers, dense and with
+blocked keys, and the latent LatentAttention layer for a range of particle
+multiplicities, e.g.
+
+    python benchmark_attention.py --batch 32 --num_part 100 250 500 1000 2000 --num_latents 16 64
+
+--backward includes the gradient with respect to the inputs and weights.
+Peak memory is measured on GPU. On CPU the size of the attention score
+tensors is reported instead.
+"""
+import time
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+
+from layers import TalkingHeadAttention, SimpleHeadAttention, LatentAttention
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the attention blocks.")
+    parser.add_argument("--batch", type=int, default=32, help="Batch size")
+    parser.add_argument("--num_part", type=int, nargs='+', default=[100, 250, 500, 1000, 2000],
+                        help="Padded number of particles")
+    parser.add_argument("--projection", type=int, default=128, help="Token dimension")
+    parser.add_argument("--num_heads", type=int, default=4, help="Number of heads")
+    parser.add_argument("--num_latents", type=int, nargs='+', default=[32], help="Number of latent tokens")
+    parser.add_argument("--block_size", type=int, nargs='+', default=[128], help="Key block sizes of the blocked layers")
+    parser.add_argument("--fill", type=float, default=0.3, help="Mean fraction of real particles")
+    parser.add_argument("--backward", action='store_true', default=False, help="Time forward and backward pass")
+    parser.add_argument("--repeat", type=int, default=10, help="Number of timed calls")
+    parser.add_argument("--output", default=None, help="Optional JSON file to store the results")
+    return parser.parse_args()
+
+
+def make_tokens(batch, num_part, projection, fill, rng):
+    nparts = np.clip(rng.poisson(fill*num_part, batch), 1, num_part)
+    mask = (np.arange(num_part)[None] < nparts[:, None]).astype(np.float32)[:, :, None]
+    tokens = rng.standard_normal((batch, num_part, projection)).astype(np.float32)*mask
+    return tf.constant(tokens), tf.constant(mask)
+
+
+def get_blocks(flags):
+    """Attention blocks as functions of the tokens (B,N,C) and mask (B,N,1)"""
+    mha = layers.MultiHeadAttention(num_heads=flags.num_heads, key_dim=flags.projection//flags.num_heads)
+    talking = TalkingHeadAttention(flags.projection, flags.num_heads, 0.0)
+    simple = SimpleHeadAttention(flags.projection, flags.num_heads, 0.0)
+    blocks = {
+        'mha': lambda x, m: mha(x, x, attention_mask=tf.transpose(m, [0, 2, 1]) > 0),
+        'talking': lambda x, m: talking(x, mask=tf.transpose(m, [0, 2, 1])[:, None] > 0)[0],
+        'simple': lambda x, m: simple(x, mask=tf.transpose(m, [0, 2, 1])[:, None] > 0)[0],
+    }
+    for block_size in flags.block_size:
+        for name, cls in [('talking', TalkingHeadAttention), ('simple', SimpleHeadAttention)]:
+            layer = cls(flags.projection, flags.num_heads, 0.0, block_size=block_size)
+            blocks[f'{name}_block{block_size}'] = \
+                lambda x, m, layer=layer: layer(x, mask=tf.transpose(m, [0, 2, 1])[:, None] > 0)[0]
+    for num_latents in flags.num_latents:
+        latent = LatentAttention(flags.projection, flags.num_heads, num_latents)
+        blocks[f'latent{num_latents}'] = lambda x, m, latent=latent: latent(x, mask=m)
+    return blocks
+
+
+def score_bytes(name, batch, num_part, num_heads):
+    # Attention probabilities of one call, or of one key block
+    if name.startswith('latent'):
+        num_latents = int(name[len('latent'):])
+        return 4*batch*num_heads*(2*num_part*num_latents + num_latents**2)
+    # Talking heads keep the scores before and after each head projection
+    copies = 3 if name.startswith('talking') else 1
+    if '_block' in name:
+        return 4*copies*batch*num_heads*num_part*min(int(name.split('_block')[1]), num_part)
+    return 4*copies*batch*num_heads*num_part**2
+
+
+def measure(fn, args, repeat, backward):
+    device = 'GPU:0' if tf.config.list_logical_devices('GPU') else None
+    if backward:
+        forward = fn
+        @tf.function
+        def fn(x, m):
+            with tf.GradientTape() as tape:
+                tape.watch(x)
+                loss = tf.reduce_sum(forward(x, m))
+            return tf.add_n([tf.reduce_sum(g) for g in tape.gradient(loss, [x] + list(tape.watched_variables()))])
+    fn(*args)  # trace
+    if device is not None:
+        tf.config.experimental.reset_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn(*args)
+    out.numpy()
+    elapsed = (time.perf_counter() - start)/repeat
+    peak = tf.config.experimental.get_memory_info(device)['peak'] if device is not None else None
+    return elapsed, peak
+
+
+def main():
+    flags = parse_arguments()
+    rng = np.random.default_rng(0)
+    blocks = get_blocks(flags)
+    results = []
+    for num_part in flags.num_part:
+        tokens, mask = make_tokens(flags.batch, num_part, flags.projection, flags.fill, rng)
+        for name, block in blocks.items():
+            elapsed, peak = measure(tf.function(block), (tokens, mask), flags.repeat, flags.backward)
+            results.append({'method': name, 'num_part': num_part, 'time': elapsed, 'peak_bytes': peak,
+                            'score_bytes': score_bytes(name, flags.batch, num_part, flags.num_heads)})
+
+    print(f"{'method':<18}{'P':>6}{'time [ms]':>12}{'scores [MiB]':>14}{'peak [MiB]':>12}")
+    for stats in results:
+        peak = f"{stats['peak_bytes']/2**20:>12.1f}" if stats['peak_bytes'] is not None else f"{'-':>12}"
+        print(f"{stats['method']:<18}{stats['num_part']:>6}{1e3*stats['time']:>12.2f}"
+              f"{stats['score_bytes']/2**20:>14.1f}{peak}")
+
+    if flags.output is not None:
+        with open(flags.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
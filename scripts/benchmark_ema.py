@@ -0,0 +1,87 @@
+"""Per-step cost of the EMA update of the PET weights.
+
+Times the update of the three EMA models after each optimizer step: the
+per-variable assign loop, the fused WeightEMA update, on the default device
+and on the host, and the fused update every few steps, e.g.
+
+    python benchmark_ema.py --projection 32 64 128 --interval 4 16
+
+The EMA decay is irrelevant for the timing, the weights are not trained.
+"""
+import time
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from PET import PET, WeightEMA
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the EMA weight update.")
+    parser.add_argument("--projection", type=int, nargs='+', default=[32, 64, 128], help="Base projection sizes")
+    parser.add_argument("--num_layers", type=int, default=6, help="Number of transformer layers")
+    parser.add_argument("--num_local", type=int, default=1, help="Number of local layers")
+    parser.add_argument("--interval", type=int, nargs='+', default=[4], help="Update intervals of the fused update")
+    parser.add_argument("--host", action='store_true', default=False, help="Also time EMA weights kept on /CPU:0")
+    parser.add_argument("--repeat", type=int, default=200, help="Number of timed steps")
+    parser.add_argument("--output", default=None, help="Optional JSON file to store the results")
+    return parser.parse_args()
+
+
+def loop_update(weights, shadows, decay):
+    #Update of PET.train_step before WeightEMA
+    for weight, shadow in zip(weights, shadows):
+        shadow.assign(decay * shadow + (1 - decay) * weight)
+
+
+def measure(fn, repeat, warmup):
+    for _ in range(warmup):  # trace, and compile the skipped update
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start)/repeat
+
+
+def main():
+    flags = parse_arguments()
+    results = []
+    for projection in flags.projection:
+        model = PET(num_feat=13, num_evt=8, num_part=50, projection_dim=projection,
+                    num_layers=flags.num_layers, num_local=flags.num_local)
+        weights = model.model_evt.weights + model.generator_head.weights + model.body.weights
+        shadows = model.ema_evt.weights + model.ema_head.weights + model.ema_body.weights
+        step = tf.Variable(0, dtype=tf.int64)
+
+        ema = WeightEMA(weights, shadows, model.ema)
+        methods = {'loop': tf.function(lambda: loop_update(weights, shadows, model.ema)),
+                   'fused': tf.function(lambda ema=ema: ema(step))}
+        for interval in flags.interval:
+            ema = WeightEMA(weights, shadows, model.ema, interval)
+            methods[f'fused_every{interval}'] = tf.function(lambda ema=ema: ema(step.assign_add(1)))
+        if flags.host:
+            host = PET(num_feat=13, num_evt=8, num_part=50, projection_dim=projection,
+                       num_layers=flags.num_layers, num_local=flags.num_local, ema_device='/CPU:0')
+            ema = WeightEMA(host.model_evt.weights + host.generator_head.weights + host.body.weights,
+                            host.ema_evt.weights + host.ema_head.weights + host.ema_body.weights,
+                            host.ema, device='/CPU:0')
+            methods['fused_host'] = tf.function(lambda ema=ema: ema(step))
+
+        num_params = int(sum(np.prod(w.shape) for w in weights))
+        for name, fn in methods.items():
+            results.append({'method': name, 'projection': projection, 'variables': len(weights),
+                            'params': num_params, 'time': measure(fn, flags.repeat, max(flags.interval))})
+
+    print(f"{'method':<16}{'proj':>6}{'vars':>6}{'params [M]':>12}{'time [ms]':>12}")
+    for stats in results:
+        print(f"{stats['method']:<16}{stats['projection']:>6}{stats['variables']:>6}"
+              f"{stats['params']/1e6:>12.2f}{1e3*stats['time']:>12.3f}")
+
+    if flags.output is not None:
+        with open(flags.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
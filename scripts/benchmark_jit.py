@@ -0,0 +1,112 @@
+"""Step time of PET with and without XLA compilation.
+
+Trains and samples an untrained model on synthetic events, once with the
+default tf.function graphs and once with jit_compile, and reports the
+compilation time (first call) and the steady state time per train step,
+test step and sampler split, e.g.
+
+    python benchmark_jit.py --batch 64 --steps 20 --num_layers 4
+
+Runs on CPU unless --gpu is given.
+"""
+import time
+import json
+import argparse
+import tempfile
+import tensorflow as tf
+import horovod.tensorflow.keras as hvd
+from tensorflow.keras.optimizers import Lion
+
+import utils
+from PET import PET, SAMPLERS
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark XLA compilation of PET.")
+    parser.add_argument("--batch", type=int, default=64, help="Batch size")
+    parser.add_argument("--steps", type=int, default=20, help="Number of timed train and test steps")
+    parser.add_argument("--nevts", type=int, default=512, help="Number of events to generate")
+    parser.add_argument("--nsplit", type=int, default=4, help="Number of splits passed to generate")
+    parser.add_argument("--sampler", default='ddim', help="Sampler to time")
+    parser.add_argument("--evt_steps", type=int, default=64, help="Number of event sampler steps")
+    parser.add_argument("--part_steps", type=int, default=32, help="Number of particle sampler steps")
+    parser.add_argument("--num_part", type=int, default=200, help="Maximum number of particles")
+    parser.add_argument("--gpu", action='store_true', default=False, help="Keep the GPUs visible")
+    parser.add_argument("--output", default=None, help="Optional JSON file to store the results")
+
+    parser.add_argument("--K", type=int, default=5, help="K neighbors")
+    parser.add_argument("--num_local", type=int, default=1, help="number of local layers for knn")
+    parser.add_argument("--num_layers", type=int, default=8, help="Number of transformer layers")
+    parser.add_argument("--projection", type=int, default=128, help="base projection size")
+    return parser.parse_args()
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run(loader, data, flags, jit_compile):
+    model = PET(num_feat=loader.num_feat,
+                num_evt=loader.num_evt,
+                num_part=loader.num_part,
+                projection_dim = flags.projection,
+                K = flags.K,
+                num_layers = flags.num_layers,
+                num_local = flags.num_local,
+                )
+    model.compile(Lion(1e-5), Lion(1e-5), jit_compile=jit_compile)
+    dataset = loader.make_tfdata()
+
+    stats = {'jit_compile': jit_compile}
+    # First call includes tracing and compilation
+    stats['train_compile'] = timed(lambda: model.fit(dataset, epochs=1, steps_per_epoch=1, verbose=0))
+    stats['train_step'] = timed(lambda: model.fit(dataset, epochs=1, steps_per_epoch=flags.steps,
+                                                  verbose=0))/flags.steps
+    stats['test_compile'] = timed(lambda: model.evaluate(dataset, steps=1, verbose=0))
+    stats['test_step'] = timed(lambda: model.evaluate(dataset, steps=flags.steps, verbose=0))/flags.steps
+
+    gen_part, gen_mask, gen_evt = data
+    def generate(nevts, nsplit):
+        model.generate(gen_part[:nevts], gen_mask[:nevts], gen_evt[:nevts], nsplit=nsplit,
+                       sampler=flags.sampler, evt_steps=flags.evt_steps, part_steps=flags.part_steps,
+                       jit_compile=jit_compile)
+    # Splits of the same size as the timed run reuse the compiled loops
+    stats['sampler_compile'] = timed(lambda: generate(gen_part.shape[0]//flags.nsplit, 1))
+    elapsed = timed(lambda: generate(gen_part.shape[0], flags.nsplit))
+    stats['sampler_split'] = elapsed/flags.nsplit
+    stats['events_per_second'] = gen_part.shape[0]/elapsed
+    return stats
+
+
+def main():
+    flags = parse_arguments()
+    assert flags.sampler in SAMPLERS, f"ERROR: unknown sampler {flags.sampler}, choose from {list(SAMPLERS)}"
+    if not flags.gpu:
+        tf.config.set_visible_devices([], 'GPU')
+    hvd.init()
+
+    folder = tempfile.mkdtemp(prefix='parnassus_bench_')
+    utils.make_synthetic_files(folder, nfiles=1, nevts=max(flags.nevts, 2*flags.batch),
+                               num_part=flags.num_part)
+    loader = utils.DataLoader(folder, names=['synthetic'], batch_size=flags.batch)
+    gen_part, gen_mask, gen_evt, _ = loader.get_preprocess_cond(flags.nevts)
+    data = (gen_part, gen_mask, gen_evt)
+
+    results = [run(loader, data, flags, jit_compile) for jit_compile in (False, True)]
+
+    print(f"{'':<18}{'graph':>12}{'xla':>12}{'speedup':>10}")
+    for key in ['train_compile', 'train_step', 'test_compile', 'test_step', 'sampler_compile', 'sampler_split']:
+        graph, xla = results[0][key], results[1][key]
+        print(f"{key + ' [s]':<18}{graph:>12.4f}{xla:>12.4f}{graph/xla:>10.2f}")
+    print(f"{'events/s':<18}{results[0]['events_per_second']:>12.1f}{results[1]['events_per_second']:>12.1f}"
+          f"{results[1]['events_per_second']/results[0]['events_per_second']:>10.2f}")
+
+    if flags.output is not None:
+        with open(flags.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Time and memory of the kNN search used by the local PET layers.
+
+Compares the dense search (full B x P x P distance matrix with the 999
+coordinate shift of the padding, then top_k) with the blocked
+knn_search for a range of particle multiplicities, e.g.
+
+    python benchmark_knn.py --batch 64 --num_part 200 400 600 800 1000
+
+Peak memory is measured on GPU. On CPU the size of the distance tensors
+is reported instead.
+"""
+import time
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from layers import knn_search
+from PET import pairwise_distance
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the kNN search.")
+    parser.add_argument("--batch", type=int, default=64, help="Batch size")
+    parser.add_argument("--num_part", type=int, nargs='+', default=[200, 400, 600, 800, 1000],
+                        help="Padded number of particles")
+    parser.add_argument("--K", type=int, default=5, help="K neighbors")
+    parser.add_argument("--num_feat", type=int, default=12, help="Number of coordinates")
+    parser.add_argument("--block_size", type=int, nargs='+', default=[64, 256], help="Key block sizes")
+    parser.add_argument("--fill", type=float, default=0.3, help="Mean fraction of real particles")
+    parser.add_argument("--repeat", type=int, default=10, help="Number of timed calls")
+    parser.add_argument("--output", default=None, help="Optional JSON file to store the results")
+    return parser.parse_args()
+
+
+def make_points(batch, num_part, num_feat, fill, rng):
+    nparts = np.clip(rng.poisson(fill*num_part, batch), 1, num_part)
+    mask = (np.arange(num_part)[None] < nparts[:, None]).astype(np.float32)[:, :, None]
+    points = rng.standard_normal((batch, num_part, num_feat)).astype(np.float32)*mask
+    return tf.constant(points), tf.constant(mask)
+
+
+def dense_knn(points, mask, K):
+    shifted = points + 999.*(1. - mask)
+    return tf.nn.top_k(-pairwise_distance(shifted, shifted), k=K)[1]
+
+
+def measure(fn, args, repeat):
+    device = 'GPU:0' if tf.config.list_logical_devices('GPU') else None
+    fn(*args)  # trace
+    if device is not None:
+        tf.config.experimental.reset_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn(*args)
+    out.numpy()
+    elapsed = (time.perf_counter() - start)/repeat
+    peak = tf.config.experimental.get_memory_info(device)['peak'] if device is not None else None
+    return elapsed, peak, out.numpy()
+
+
+def main():
+    flags = parse_arguments()
+    rng = np.random.default_rng(0)
+    results = []
+    for num_part in flags.num_part:
+        points, mask = make_points(flags.batch, num_part, flags.num_feat, flags.fill, rng)
+
+        dense = tf.function(lambda x, m: dense_knn(x, m, flags.K))
+        elapsed, peak, reference = measure(dense, (points, mask), flags.repeat)
+        results.append({'method': 'dense', 'num_part': num_part, 'time': elapsed, 'peak_bytes': peak,
+                        'distance_bytes': 4*flags.batch*num_part*num_part})
+
+        for block_size in flags.block_size:
+            blocked = tf.function(lambda x, m: knn_search(x, x, m, m, flags.K, block_size))
+            elapsed, peak, indices = measure(blocked, (points, mask), flags.repeat)
+            results.append({'method': f'block{block_size}', 'num_part': num_part, 'time': elapsed,
+                            'peak_bytes': peak,
+                            'distance_bytes': 4*flags.batch*num_part*(flags.K + min(block_size, num_part)),
+                            'match': bool((indices == reference).all())})
+
+    print(f"{'method':<12}{'P':>6}{'time [ms]':>12}{'dist [MiB]':>12}{'peak [MiB]':>12}{'match':>7}")
+    for stats in results:
+        peak = f"{stats['peak_bytes']/2**20:>12.1f}" if stats['peak_bytes'] is not None else f"{'-':>12}"
+        print(f"{stats['method']:<12}{stats['num_part']:>6}{1e3*stats['time']:>12.2f}"
+              f"{stats['distance_bytes']/2**20:>12.1f}{peak}{str(stats.get('match', '')):>7}")
+
+    if flags.output is not None:
+        with open(flags.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
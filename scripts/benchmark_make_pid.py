@@ -0,0 +1,84 @@
+"""Host cost of the particle pids and mask built by PET.generate.
+
+Compares the per-event loop of make_pid and the tiled mask of the former
+generate with the vectorized PET.make_pid and PET.particle_masks, on
+multiplicities from revert_npart of random event predictions, e.g.
+
+    python benchmark_make_pid.py --nevts 10000 100000 1000000 --max_part 200
+
+make_pid runs with XLA, the compilation for a new number of events is done
+before timing. Both layouts must be identical, negative class counts
+included. The benchmark fails otherwise.
+"""
+import time
+import json
+import argparse
+import numpy as np
+
+import utils
+from PET import make_pid
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the particle pid and mask construction.")
+    parser.add_argument("--nevts", type=int, nargs='+', default=[10000, 100000], help="Numbers of events")
+    parser.add_argument("--max_part", type=int, default=200, help="Maximum number of particles")
+    parser.add_argument("--output", default=None, help="Optional JSON file to store the results")
+    return parser.parse_args()
+
+
+def loop_masks(npids, max_part):
+    #make_pid and mask of generate before vectorization
+    onehot = np.zeros((npids.shape[0], max_part, npids.shape[-1]), dtype=np.float32)
+    num_part_init = np.zeros(npids.shape[0], dtype=int)
+    for i in range(npids.shape[-1]):
+        num_part_end = num_part_init + npids[:, i].astype(int)
+        for j in range(npids.shape[0]):
+            onehot[j, num_part_init[j]:num_part_end[j], i] = 1
+        num_part_init = num_part_end
+    nparts = np.expand_dims(np.clip(np.sum(npids, -1), 1, max_part), -1)
+    mask = np.expand_dims(
+        np.tile(np.arange(max_part), (nparts.shape[0], 1)) < np.tile(nparts, (1, max_part)), -1)
+    assert np.sum(np.sum(mask.reshape(mask.shape[0], -1), -1, keepdims=True) - nparts) == 0
+    return onehot, mask
+
+
+def vectorized_masks(npids, max_part):
+    #PET.particle_masks without the padding of the split
+    nparts = np.clip(np.sum(npids, -1, keepdims=True), 1, max_part)
+    return make_pid(npids, max_part), (np.arange(max_part)[None] < nparts)[:, :, None]
+
+
+def measure(fn, npids, max_part):
+    fn(npids, max_part)  # compile
+    start = time.perf_counter()
+    out = fn(npids, max_part)
+    return time.perf_counter() - start, out
+
+
+def main():
+    flags = parse_arguments()
+    rng = np.random.default_rng(0)
+    results = []
+    for nevts in flags.nevts:
+        #Wide predictions, so some counts come out negative or above max_part
+        npids = utils.revert_npart(2*rng.standard_normal((nevts, 5)))
+        loop_time, (pid_ref, mask_ref) = measure(loop_masks, npids, flags.max_part)
+        vec_time, (pid, mask) = measure(vectorized_masks, npids, flags.max_part)
+        assert np.array_equal(pid, pid_ref), 'ERROR: one-hot pids differ from the loop'
+        assert np.array_equal(mask, mask_ref), 'ERROR: particle masks differ from the loop'
+        results.append({'nevts': nevts, 'max_part': flags.max_part, 'loop': loop_time,
+                        'vectorized': vec_time, 'negative_counts': int(np.sum(npids < 0))})
+
+    print(f"{'nevts':>10}{'loop [s]':>12}{'vectorized [s]':>16}{'speedup':>10}")
+    for stats in results:
+        print(f"{stats['nevts']:>10}{stats['loop']:>12.3f}{stats['vectorized']:>16.3f}"
+              f"{stats['loop']/stats['vectorized']:>10.1f}")
+
+    if flags.output is not None:
+        with open(flags.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
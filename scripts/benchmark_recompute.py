@@ -0,0 +1,91 @@
+"""Peak memory and step time of PET training with and without recompute.
+
+Trains an untrained model on synthetic events for a range of batch sizes,
+once keeping all activations for the backward pass and once recomputing
+the activations inside the attention and gelu Dense layers of the body
+(PET recompute=True), e.g.
+
+    python benchmark_recompute.py --batch 32 64 128 256 --num_part 200 --gpu
+
+Peak memory is measured on GPU, on CPU only the step time is reported.
+Runs on CPU unless --gpu is given.
+"""
+import time
+import json
+import argparse
+import tempfile
+import tensorflow as tf
+import horovod.tensorflow.keras as hvd
+from tensorflow.keras.optimizers import Lion
+
+import utils
+from PET import PET
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark activation recomputation in PET.")
+    parser.add_argument("--batch", type=int, nargs='+', default=[32, 64, 128], help="Batch sizes")
+    parser.add_argument("--steps", type=int, default=10, help="Number of timed train steps")
+    parser.add_argument("--num_part", type=int, default=200, help="Maximum number of particles")
+    parser.add_argument("--jit", action='store_true', default=False, help="Compile the train step with XLA")
+    parser.add_argument("--gpu", action='store_true', default=False, help="Keep the GPUs visible")
+    parser.add_argument("--output", default=None, help="Optional JSON file to store the results")
+
+    parser.add_argument("--K", type=int, default=5, help="K neighbors")
+    parser.add_argument("--num_local", type=int, default=1, help="number of local layers for knn")
+    parser.add_argument("--num_layers", type=int, default=8, help="Number of transformer layers")
+    parser.add_argument("--projection", type=int, default=128, help="base projection size")
+    return parser.parse_args()
+
+
+def run(folder, batch, flags, recompute):
+    loader = utils.DataLoader(folder, names=['synthetic'], batch_size=batch)
+    model = PET(num_feat=loader.num_feat,
+                num_evt=loader.num_evt,
+                num_part=loader.num_part,
+                projection_dim = flags.projection,
+                K = flags.K,
+                num_layers = flags.num_layers,
+                num_local = flags.num_local,
+                recompute = recompute,
+                )
+    model.compile(Lion(1e-5), Lion(1e-5), jit_compile=flags.jit)
+    dataset = loader.make_tfdata()
+    device = 'GPU:0' if tf.config.list_logical_devices('GPU') else None
+
+    model.fit(dataset, epochs=1, steps_per_epoch=1, verbose=0)  # trace
+    if device is not None:
+        tf.config.experimental.reset_memory_stats(device)
+    start = time.perf_counter()
+    model.fit(dataset, epochs=1, steps_per_epoch=flags.steps, verbose=0)
+    elapsed = (time.perf_counter() - start)/flags.steps
+    peak = tf.config.experimental.get_memory_info(device)['peak'] if device is not None else None
+    return {'recompute': recompute, 'batch': batch, 'train_step': elapsed,
+            'events_per_second': batch/elapsed, 'peak_bytes': peak}
+
+
+def main():
+    flags = parse_arguments()
+    if not flags.gpu:
+        tf.config.set_visible_devices([], 'GPU')
+    hvd.init()
+
+    folder = tempfile.mkdtemp(prefix='parnassus_bench_')
+    utils.make_synthetic_files(folder, nfiles=1, nevts=(flags.steps + 1)*max(flags.batch),
+                               num_part=flags.num_part)
+    results = [run(folder, batch, flags, recompute)
+               for batch in flags.batch for recompute in (False, True)]
+
+    print(f"{'recompute':<10}{'batch':>7}{'step [ms]':>12}{'events/s':>12}{'peak [MiB]':>12}")
+    for stats in results:
+        peak = f"{stats['peak_bytes']/2**20:>12.1f}" if stats['peak_bytes'] is not None else f"{'-':>12}"
+        print(f"{str(stats['recompute']):<10}{stats['batch']:>7}{1e3*stats['train_step']:>12.1f}"
+              f"{stats['events_per_second']:>12.1f}{peak}")
+
+    if flags.output is not None:
+        with open(flags.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Quality vs speed of the PET samplers.
+
+Generates the same conditioning events with every sampler in --samplers,
+given as name:evt_steps:part_steps, and compares the distributions plotted by
+sample.py against the reference sampler (512/64 step DDPM by default) and,
+when available, the reco events of the validation file, e.g.
+
+    python benchmark_sampler.py --nevts 20000 --samplers ddim:64:32 dpm:32:16 dpm:16:8
+
+--synthetic runs an untrained model on random events to measure speed only.
+"""
+import os
+import time
+import json
+import argparse
+import tempfile
+import numpy as np
+from scipy.stats import wasserstein_distance
+import tensorflow as tf
+import horovod.tensorflow.keras as hvd
+
+import utils
+from PET import PET, SAMPLERS
+from sample import get_model_name
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the PET samplers.")
+    parser.add_argument("--folder", default="/mscratch/sd/v/vmikuni/parnassus/", help="Folder containing input files")
+    parser.add_argument("--val_file", default="val_ggF", help="Validation file used as conditioning")
+    parser.add_argument("--nevts", type=int, default=10000, help="Number of events to generate")
+    parser.add_argument("--nsplit", type=int, default=10, help="Number of splits passed to generate")
+    parser.add_argument("--samplers", nargs='+', default=['ddim:64:32','dpm:32:16','dpm:16:8'],
+                        help="Samplers to compare as name:evt_steps:part_steps")
+    parser.add_argument("--reference", default='ddpm:512:64', help="Reference sampler as name:evt_steps:part_steps")
+    parser.add_argument("--time_tables", action='store_true', default=False, help='Precompute the time conditioning of all sampler steps')
+    parser.add_argument("--synthetic", action='store_true', default=False, help="Untrained model on random events, timing only")
+    parser.add_argument("--output", default=None, help="Optional JSON file to store the results")
+
+    parser.add_argument("--K", type=int, default=5, help="K neighbors")
+    parser.add_argument("--num_local", type=int, default=1, help="number of local layers for knn")
+    parser.add_argument("--num_layers", type=int, default=8, help="Number of transformer layers")
+    parser.add_argument("--projection", type=int, default=128, help="base projection size")
+    return parser.parse_args()
+
+
+def parse_sampler(spec):
+    name, evt_steps, part_steps = spec.split(':')
+    assert name in SAMPLERS, f"ERROR: unknown sampler {name}, choose from {list(SAMPLERS)}"
+    return name, int(evt_steps), int(part_steps)
+
+
+def model_evaluations(name, evt_steps, part_steps):
+    # DDPM uses a second model call per step at the logsnr midpoint
+    return (2 if name == 'ddpm' else 1)*(evt_steps + part_steps)
+
+
+def run_sampler(model, data, loader, spec, flags):
+    name, evt_steps, part_steps = parse_sampler(spec)
+    gen_part, gen_mask, gen_evt = data
+    # Trace once outside the timed region
+    model.generate(gen_part[:2], gen_mask[:2], gen_evt[:2], nsplit=1, sampler=name,
+                   evt_steps=evt_steps, part_steps=part_steps, time_tables=flags.time_tables)
+    start = time.perf_counter()
+    p, j = model.generate(gen_part, gen_mask, gen_evt, nsplit=flags.nsplit, sampler=name,
+                          evt_steps=evt_steps, part_steps=part_steps, time_tables=flags.time_tables)
+    elapsed = time.perf_counter() - start
+    p = loader.revert_preprocess(p, p[:, :, 2] != 0)
+    j = loader.revert_preprocess_evt(j)
+    stats = {'sampler': spec, 'time': elapsed, 'events_per_second': p.shape[0]/elapsed,
+             'model_evaluations': model_evaluations(name, evt_steps, part_steps)}
+    return stats, (j, p)
+
+
+def distances(evts, parts, evts_ref, parts_ref):
+    """Wasserstein-1 distance per variable, in units of the reference std."""
+    def w1(x, ref):
+        return float(wasserstein_distance(x, ref)/(np.std(ref) + 1e-8))
+    parts = parts.reshape((-1, parts.shape[-1]))
+    parts = parts[parts[:, 2] != 0]
+    parts_ref = parts_ref.reshape((-1, parts_ref.shape[-1]))
+    parts_ref = parts_ref[parts_ref[:, 2] != 0]
+    return {'evt': [w1(evts[:, i], evts_ref[:, i]) for i in range(evts.shape[1])],
+            'part': [w1(parts[:, i], parts_ref[:, i]) for i in range(parts.shape[1])]}
+
+
+def main():
+    flags = parse_arguments()
+    hvd.init()
+    if flags.synthetic:
+        flags.folder = tempfile.mkdtemp(prefix='parnassus_bench_')
+        flags.val_file = 'synthetic'
+        utils.make_synthetic_files(flags.folder, nfiles=1, nevts=flags.nevts)
+
+    loader = utils.DataLoader(flags.folder, names=[flags.val_file])
+    model = PET(num_feat=loader.num_feat,
+                num_evt=loader.num_evt,
+                num_part=loader.num_part,
+                projection_dim = flags.projection,
+                K = flags.K,
+                num_layers = flags.num_layers,
+                num_local = flags.num_local,
+                )
+    if not flags.synthetic:
+        model.load_weights(os.path.join(flags.folder, 'checkpoints', get_model_name(flags)))
+
+    gen_part, gen_mask, gen_evt, _ = loader.get_preprocess_cond(flags.nevts)
+    data = (gen_part, gen_mask, gen_evt)
+
+    results = []
+    ref_stats, (evts_ref, parts_ref) = run_sampler(model, data, loader, flags.reference, flags)
+    if not flags.synthetic:
+        reco, _, reco_mask, _, reco_evt, _ = loader.data_from_file(loader.files, nevts=flags.nevts)
+        reco = loader.revert_preprocess(loader.preprocess(reco, reco_mask), reco_mask)
+        ref_stats['truth'] = distances(evts_ref, parts_ref, reco_evt, reco)
+    results.append(ref_stats)
+
+    for spec in flags.samplers:
+        stats, (evts, parts) = run_sampler(model, data, loader, spec, flags)
+        stats['reference'] = distances(evts, parts, evts_ref, parts_ref)
+        if not flags.synthetic:
+            stats['truth'] = distances(evts, parts, reco_evt, reco)
+        results.append(stats)
+
+    print(f"{'sampler':<16}{'NFE':>6}{'events/s':>12}{'evt W1':>10}{'part W1':>10}")
+    for stats in results:
+        ref = stats.get('reference', {'evt': [0.0], 'part': [0.0]})
+        print(f"{stats['sampler']:<16}{stats['model_evaluations']:>6}{stats['events_per_second']:>12.1f}"
+              f"{np.mean(ref['evt']):>10.3f}{np.mean(ref['part']):>10.3f}")
+
+    if flags.output is not None:
+        with open(flags.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,7 @@ class StochasticDepth(layers.Layer):
             keep_prob = 1 - self.drop_prob
             shape = (tf.shape(x)[0],) + (1,) * (len(x.shape) - 1)
             random_tensor = keep_prob + tf.random.uniform(
-                shape, minval=0, maxval=1)
+                shape, minval=0, maxval=1, dtype=x.dtype)
             random_tensor = tf.floor(random_tensor)
             return x * random_tensor
         
@@ -38,7 +38,7 @@ class RandomDrop(layers.Layer):
             keep_prob = 1 - self.drop_prob
             shape = (tf.shape(x)[0],1) 
             random_tensor = keep_prob + tf.random.uniform(
-                shape, minval=0, maxval=1)
+                shape, minval=0, maxval=1, dtype=x.dtype)
             random_tensor = tf.floor(random_tensor)
             x[:,:,self.num_skip:] = x[:,:,self.num_skip:] * random_tensor[:,None]
             return x
@@ -54,21 +54,25 @@ class SimpleHeadAttention(layers.Layer):
         num_heads (int): number of attention heads.
         dropout_rate (float): dropout rate to be used for dropout in the attention
             scores as well as the final projected outputs.
+        block_size (int): if set, keys are processed in blocks of block_size with
+            an online softmax and the attention matrix is not returned.
     """
     def __init__(
-        self, projection_dim: int, num_heads: int, dropout_rate: float, **kwargs
+        self, projection_dim: int, num_heads: int, dropout_rate: float, block_size: int = None, **kwargs
     ):
         super().__init__(**kwargs)
         self.num_heads = num_heads
         self.projection_dim = projection_dim
         self.dropout_rate = dropout_rate
+        self.block_size = block_size
         
         head_dim = self.projection_dim // self.num_heads
         self.scale = head_dim**-0.5
         self.qkv = layers.Dense(projection_dim * 3)
         self.proj = layers.Dense(projection_dim)
         self.proj_drop = layers.Dropout(dropout_rate)
-        self.softmax = layers.Softmax(axis=-1)
+        #Softmax in float32 under mixed precision
+        self.softmax = layers.Softmax(axis=-1, dtype='float32')
 
     def call(self, x,int_matrix = None,mask=None, training=False):
         B, N, C = tf.shape(x)[0], tf.shape(x)[1], tf.shape(x)[2]
@@ -86,23 +90,24 @@ class SimpleHeadAttention(layers.Layer):
         scale = tf.cast(self.scale, dtype=qkv.dtype)
         q, k, v = qkv[0] * scale, qkv[1], qkv[2]
 
-        # Obtain the raw attention scores.
-        attn = tf.matmul(q, k, transpose_b = True)
-        
-        # Normalize the attention scores.
+        if self.block_size:
+            x = blocked_attention(q, k, v, self.block_size, mask=mask, int_matrix=int_matrix)
+            attn = None
+        else:
+            # Obtain the raw attention scores.
+            attn = tf.matmul(q, k, transpose_b = True)
 
-        if int_matrix is not None:
-            attn+=int_matrix
+            # Normalize the attention scores.
 
-        if mask is not None:
-            mask = tf.cast(mask, dtype=attn.dtype)
-            mask = tf.tile(mask, [1, tf.shape(attn)[1], 1, 1])
-            attn += (1.0-mask)*-1e9
+            if int_matrix is not None:
+                attn+=int_matrix
 
-        attn = self.softmax(attn)
+            #Masked scores get the most negative value safe for the softmax dtype
+            #instead of a fixed -1e9, which overflows in float16
+            attn = tf.cast(self.softmax(attn, mask), v.dtype)
 
-        # Final set of projections as done in the vanilla attention mechanism.
-        x = tf.matmul(attn, v)
+            # Final set of projections as done in the vanilla attention mechanism.
+            x = tf.matmul(attn, v)
         x = tf.transpose(x, perm=[0, 2, 1, 3])
         x = tf.reshape(x, (B, N, C))
         
@@ -118,14 +123,19 @@ class TalkingHeadAttention(layers.Layer):
         num_heads (int): number of attention heads.
         dropout_rate (float): dropout rate to be used for dropout in the attention
             scores as well as the final projected outputs.
+        block_size (int): if set, keys are processed in blocks of block_size with
+            an online softmax and the attention matrix is not returned. Attention
+            dropout needs the full matrix, so training with dropout_rate > 0
+            uses the unblocked path.
     """
     def __init__(
-        self, projection_dim: int, num_heads: int, dropout_rate: float, **kwargs
+        self, projection_dim: int, num_heads: int, dropout_rate: float, block_size: int = None, **kwargs
     ):
         super().__init__(**kwargs)
         self.num_heads = num_heads
         self.projection_dim = projection_dim
         self.dropout_rate = dropout_rate
+        self.block_size = block_size
         
         head_dim = self.projection_dim // self.num_heads
         self.scale = head_dim**-0.5
@@ -135,7 +145,15 @@ class TalkingHeadAttention(layers.Layer):
         self.proj_l = layers.Dense(self.num_heads)
         self.proj_w = layers.Dense(self.num_heads)
         self.proj_drop = layers.Dropout(dropout_rate)
-        self.softmax = layers.Softmax(axis=-1)
+        #Softmax in float32 under mixed precision
+        self.softmax = layers.Softmax(axis=-1, dtype='float32')
+
+    def build(self, input_shape):
+        # The head projections are applied as einsum contractions over the
+        # head axis, so their kernels are needed before the first call
+        self.proj_l.build((None, self.num_heads))
+        self.proj_w.build((None, self.num_heads))
+        super().build(input_shape)
 
     def call(self, x,int_matrix = None,mask=None, training=False):
         B, N, C = tf.shape(x)[0], tf.shape(x)[1], tf.shape(x)[2]
@@ -153,33 +171,30 @@ class TalkingHeadAttention(layers.Layer):
         scale = tf.cast(self.scale, dtype=qkv.dtype)
         q, k, v = qkv[0] * scale, qkv[1], qkv[2]
 
-        # Obtain the raw attention scores.
-        attn = tf.matmul(q, k, transpose_b = True)
-        if int_matrix is not None:
-            attn+=int_matrix
+        if self.block_size and not (training and self.dropout_rate > 0):
+            x = blocked_attention(q, k, v, self.block_size, mask=mask, int_matrix=int_matrix,
+                                  logit_mix=(self.proj_l.kernel, self.proj_l.bias),
+                                  prob_mix=(self.proj_w.kernel, self.proj_w.bias))
+            attn = None
+        else:
+            # Obtain the raw attention scores.
+            attn = tf.matmul(q, k, transpose_b = True)
+            if int_matrix is not None:
+                attn+=int_matrix
 
+            # Linear projection of the similarities between the query and key projections.
+            attn = mix_heads(attn, self.proj_l.kernel, self.proj_l.bias)
 
-        # Linear projection of the similarities between the query and key projections.
-        attn = self.proj_l(tf.transpose(attn, perm=[0, 2, 3, 1]))
-        
-        # Normalize the attention scores.
-        attn = tf.transpose(attn, perm=[0, 3, 1, 2])
-        
-        if mask is not None:
-            mask = tf.cast(mask, dtype=attn.dtype)
-            mask = tf.tile(mask, [1, tf.shape(attn)[1], 1, 1])
-            attn += (1.0-mask)*-1e9
+            #Masked scores get the most negative value safe for the softmax dtype
+            #instead of a fixed -1e9, which overflows in float16
+            attn = tf.cast(self.softmax(attn, mask), v.dtype)
 
-        attn = self.softmax(attn)
-                
-        
-        # Linear projection on the softmaxed scores.
-        attn = self.proj_w(tf.transpose(attn, perm=[0, 2, 3, 1]))
-        attn = tf.transpose(attn, perm=[0, 3, 1, 2])
-        attn = self.attn_drop(attn, training=training)
+            # Linear projection on the softmaxed scores.
+            attn = mix_heads(attn, self.proj_w.kernel, self.proj_w.bias)
+            attn = self.attn_drop(attn, training=training)
 
-        # Final set of projections as done in the vanilla attention mechanism.
-        x = tf.matmul(attn, v)
+            # Final set of projections as done in the vanilla attention mechanism.
+            x = tf.matmul(attn, v)
         x = tf.transpose(x, perm=[0, 2, 1, 3])
         x = tf.reshape(x, (B, N, C))
         
@@ -188,6 +203,99 @@ class TalkingHeadAttention(layers.Layer):
         return x, attn
 
 
+def mix_heads(attn, kernel, bias):
+    # Dense layer over the head axis of (B, H, N, M) scores, without moving
+    # the heads last and back
+    return tf.einsum('bgnm,gh->bhnm', attn, tf.cast(kernel, attn.dtype)) \
+        + tf.cast(bias, attn.dtype)[:, None, None]
+
+
+def blocked_attention(q, k, v, block_size, mask=None, int_matrix=None, logit_mix=None, prob_mix=None):
+    """softmax(q k^T + int_matrix, mask) v computed over blocks of block_size
+    keys with a running maximum and normalization (online softmax), so only
+    (B, H, N, block_size) scores exist at a time instead of (B, H, N, N).
+    q, k, v are (B, H, N, head_dim) with q already scaled. mask and int_matrix
+    broadcast to (B, H, N, M), masks of shape (..., 1) are not sliced.
+    logit_mix and prob_mix are (kernel, bias) pairs mixing the heads of the
+    scores before and after the softmax, as in talking-head attention.
+    Scores are kept in float32 like the Softmax layers."""
+    num_keys = tf.shape(k)[2]
+    block_size = tf.minimum(block_size, num_keys)
+    num_blocks = (num_keys + block_size - 1)//block_size
+    pad = num_blocks*block_size - num_keys
+
+    def pad_keys(x, axis):
+        # Fixed block size, padding the key axis, so that the slices have a static size under XLA
+        if x is None or x.shape[axis] == 1:
+            return x
+        paddings = [[0, 0]]*len(x.shape)
+        paddings[axis] = [0, pad]
+        return tf.pad(x, paddings)
+
+    def key_block(x, start, axis):
+        if x is None or x.shape[axis] == 1:
+            return x
+        begin = [0]*len(x.shape)
+        size = [-1]*len(x.shape)
+        begin[axis] = start
+        size[axis] = block_size
+        return tf.slice(x, begin, size)
+
+    k, v = pad_keys(k, 2), pad_keys(v, 2)
+    mask, int_matrix = pad_keys(mask, -1), pad_keys(int_matrix, -1)
+    q = tf.cast(q, tf.float32)
+    large_negative = tf.constant(-1e9, tf.float32)
+
+    shape = tf.shape(q)
+    best = tf.fill(shape[:3], tf.constant(float('-inf'), tf.float32))
+    norm = tf.zeros(shape[:3], tf.float32)
+    if prob_mix is None:
+        acc = tf.zeros(shape, tf.float32)
+    else:
+        # Normalizations differ per head, so the value sums are kept for every
+        # pair of (softmax head, value head) and mixed at the end
+        acc = tf.zeros(tf.concat([shape[:2], shape[1:2], shape[2:]], 0), tf.float32)
+
+    def step(block, best, norm, acc):
+        start = block*block_size
+        scores = tf.matmul(q, tf.cast(key_block(k, start, 2), tf.float32), transpose_b=True)
+        if int_matrix is not None:
+            scores += tf.cast(key_block(int_matrix, start, -1), tf.float32)
+        if logit_mix is not None:
+            scores = mix_heads(scores, *logit_mix)
+        if mask is not None:
+            scores += (1.0 - tf.cast(key_block(mask, start, -1), tf.float32))*large_negative
+        # Padded keys of the last block do not contribute
+        valid = start + tf.range(block_size) < num_keys
+        scores = tf.where(valid, scores, tf.constant(float('-inf'), tf.float32))
+
+        new_best = tf.maximum(best, tf.reduce_max(scores, -1))
+        rescale = tf.exp(best - new_best)
+        probs = tf.exp(scores - new_best[..., None])
+        norm = norm*rescale + tf.reduce_sum(probs, -1)
+        values = key_block(v, start, 2)
+        probs = tf.cast(probs, values.dtype)
+        if prob_mix is None:
+            update = tf.matmul(probs, values)
+            acc = acc*rescale[..., None] + tf.cast(update, tf.float32)
+        else:
+            update = tf.einsum('bgnm,bhmd->bghnd', probs, values)
+            acc = acc*rescale[:, :, None, :, None] + tf.cast(update, tf.float32)
+        return block + 1, new_best, norm, acc
+
+    # maximum_iterations lets XLA size the loop accumulators of the backward pass
+    _, best, norm, acc = tf.while_loop(lambda block, *_: block < num_blocks, step,
+                                       (tf.constant(0), best, norm, acc),
+                                       maximum_iterations=num_blocks)
+    if prob_mix is None:
+        return tf.cast(acc/norm[..., None], v.dtype)
+    kernel, bias = prob_mix
+    # The bias of the mixing is added to every score, including masked ones
+    out = tf.einsum('bghnd,gh->bhnd', acc/norm[:, :, None, :, None], tf.cast(kernel, tf.float32)) \
+        + tf.cast(bias, tf.float32)[:, None, None]*tf.reduce_sum(tf.cast(v, tf.float32), 2, keepdims=True)
+    return tf.cast(out, v.dtype)
+
+
 class LayerScale(layers.Layer):
     def __init__(self, init_values, projection_dim, **kwargs):
         super(LayerScale, self).__init__(**kwargs)
@@ -208,7 +316,181 @@ class LayerScale(layers.Layer):
     def call(self, inputs,mask=None):
         # Element-wise multiplication of inputs and gamma
         if mask is not None:
-            return inputs * self.gamma* mask
+            return inputs * self.gamma* tf.cast(mask, inputs.dtype)
         else:
             return inputs * self.gamma
 
+
+
+class SlotAdd(layers.Add):
+    """Add of per-slot token features, with the later inputs cut to the
+    number of slots of the first. The reco tokens can then be fewer than
+    the gen tokens they read, when the particle padding is trimmed."""
+    def _merge_function(self, inputs):
+        num_slots = tf.shape(inputs[0])[1]
+        return super()._merge_function([inputs[0]] + [x[:, :num_slots] for x in inputs[1:]])
+
+
+class SlotConcat(layers.Layer):
+    """Concatenation of token features along the slots, each input cut to the
+    number of slots of its mask. Trimming the padding inside the concatenation
+    adds no node to the model, so the order of its weights is unchanged."""
+    def call(self, inputs, masks):
+        return tf.concat([x[:, :tf.shape(mask)[1]] for x, mask in zip(inputs, masks)], 1)
+
+
+def knn_search(points_query, points_key, mask_query, mask_key, K, block_size=256):
+    """Indices of the K nearest keys of every query point. Distances are
+    computed over blocks of block_size keys while keeping a running top-K,
+    so memory grows with B*P*(K+block_size) instead of B*P*P. Padded slots
+    are moved by 999 in every coordinate, so real particles see the real
+    ones first and then the nearest padded slots, and padded slots see the
+    padded ones first.
+    Args:
+        points_query (tf.Tensor): (B, P, D) query coordinates.
+        points_key (tf.Tensor): (B, N, D) key coordinates.
+        mask_query (tf.Tensor): (B, P, 1) query mask.
+        mask_key (tf.Tensor): (B, N, 1) key mask.
+        K (int): number of neighbors.
+        block_size (int): number of keys per distance block.
+    """
+    # Indices carry no gradient. Stopping it here also keeps the while
+    # loop out of the backward pass, which XLA cannot compile.
+    # Distances in float32 under mixed precision
+    points_query = tf.stop_gradient(tf.cast(points_query, tf.float32))
+    points_key = tf.stop_gradient(tf.cast(points_key, tf.float32))
+    points_query += 999.*tf.cast(mask_query <= 0, tf.float32)
+    points_key += 999.*tf.cast(mask_key <= 0, tf.float32)
+    num_keys = tf.shape(points_key)[1]
+
+    # Fixed block size, padding the keys to a multiple of it, so that the
+    # slices have a static size under XLA
+    block_size = tf.minimum(block_size, num_keys)
+    num_blocks = (num_keys + block_size - 1)//block_size
+    points_key = tf.pad(points_key, [[0, 0], [0, num_blocks*block_size - num_keys], [0, 0]])
+    r_query = tf.reduce_sum(points_query * points_query, axis=-1, keepdims=True)
+    r_key = tf.transpose(tf.reduce_sum(points_key * points_key, axis=-1, keepdims=True), perm=[0, 2, 1])
+
+    shape = tf.concat([tf.shape(points_query)[:2], [K]], 0)
+    best_dist = tf.fill(shape, float('inf'))
+    best_index = tf.zeros(shape, dtype=tf.int32)
+
+    def step(block, best_dist, best_index):
+        start = block*block_size
+        keys = tf.slice(points_key, [0, start, 0], [-1, block_size, -1])
+        dist = r_query - 2 * tf.matmul(points_query, keys, transpose_b=True) \
+            + tf.slice(r_key, [0, 0, start], [-1, -1, block_size])
+        index = start + tf.range(block_size)
+        dist = tf.where(index < num_keys, dist, float('inf'))
+        index = tf.broadcast_to(index, tf.shape(dist))
+
+        # Earlier keys come first, so ties keep the lowest index like top_k
+        dist = tf.concat([best_dist, dist], -1)
+        index = tf.concat([best_index, index], -1)
+        neg_dist, pos = tf.nn.top_k(-dist, k=K)
+        return block + 1, -neg_dist, tf.gather(index, pos, batch_dims=2)
+
+    _, _, best_index = tf.while_loop(lambda block, *_: block < num_blocks, step,
+                                     (tf.constant(0), best_dist, best_index))
+    return best_index
+
+
+class NeighborFeatures(layers.Layer):
+    """Edge features of the K nearest neighbors, [neighbor - center, center],
+    with the neighbors from knn_search or from precomputed indices.
+    The search, the gather and the concatenation are a single node, so the
+    local Dense layers that read them keep their place in the model.
+    Args:
+        K (int): number of neighbors.
+        block_size (int): number of keys per distance block.
+    """
+    def __init__(self, K: int, block_size: int = 256, **kwargs):
+        #The points are cast to float32 for the search, the features are kept as they are
+        kwargs.setdefault('autocast', False)
+        super().__init__(**kwargs)
+        self.K = K
+        self.block_size = block_size
+
+    def call(self, points_key, points_query, features_key, features_query,
+             mask_key, mask_query, indices=None):
+        #Keys before queries: the order of the inputs sets the order of the
+        #local Dense weights in the model, as the gather of the former get_neighbors
+        if indices is None:
+            indices = knn_search(points_query, points_key, mask_query, mask_key,
+                                 self.K, self.block_size)  # (B, P, K)
+        knn_fts = tf.gather(features_key, indices, batch_dims=1)  # (B, P, K, C)
+        knn_fts_center = tf.broadcast_to(tf.expand_dims(features_query, 2), tf.shape(knn_fts))
+        return tf.concat([knn_fts - knn_fts_center, knn_fts_center], -1)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'K': self.K, 'block_size': self.block_size})
+        return config
+
+
+class LatentAttention(layers.Layer):
+    """Perceiver-style attention through a small set of learned latent tokens:
+    the latents cross-attend to the inputs, self-attend, and the inputs read
+    the result back with a second cross-attention. The cost is linear in the
+    number of tokens, N*num_latents instead of N*N.
+    Args:
+        projection_dim (int): token dimension.
+        num_heads (int): number of attention heads.
+        num_latents (int): number of learned latent tokens.
+    """
+    def __init__(self, projection_dim: int, num_heads: int, num_latents: int = 32, **kwargs):
+        super().__init__(**kwargs)
+        self.projection_dim = projection_dim
+        self.num_heads = num_heads
+        self.num_latents = num_latents
+        key_dim = projection_dim // num_heads
+        self.attn_in = layers.MultiHeadAttention(num_heads=num_heads, key_dim=key_dim)
+        self.attn_latent = layers.MultiHeadAttention(num_heads=num_heads, key_dim=key_dim)
+        self.attn_out = layers.MultiHeadAttention(num_heads=num_heads, key_dim=key_dim)
+        self.norm_in = layers.GroupNormalization(groups=1)
+        self.norm_latent = layers.GroupNormalization(groups=1)
+
+    def build(self, input_shape):
+        self.latents = self.add_weight(
+            shape=(self.num_latents, self.projection_dim),
+            initializer=tf.keras.initializers.TruncatedNormal(stddev=0.02),
+            trainable=True,
+            name='latents'
+        )
+        super().build(input_shape)
+
+    def call(self, x, mask=None):
+        # mask (B, N, 1): padded tokens are not read by the latents
+        key_mask = None if mask is None else tf.transpose(mask, perm=[0, 2, 1]) > 0
+        latents = tf.broadcast_to(tf.cast(self.latents, x.dtype),
+                                  [tf.shape(x)[0], self.num_latents, self.projection_dim])
+        latents = latents + self.attn_in(latents, x, attention_mask=key_mask)
+        y = self.norm_in(latents)
+        latents = latents + self.attn_latent(y, y)
+        return self.attn_out(x, self.norm_latent(latents))
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'projection_dim': self.projection_dim, 'num_heads': self.num_heads,
+                       'num_latents': self.num_latents})
+        return config
+
+
+def recomputed(layer):
+    """Calls layer under tf.recompute_grad. Only the inputs of the call are
+    kept for the backward pass, the activations inside the layer are
+    recomputed from them, trading one extra forward pass of the layer for
+    memory. The layer and the model around it are unchanged, so the weights
+    load with or without recompute.
+    Args:
+        layer (layers.Layer): layer to wrap, returned for chaining.
+    """
+    call = layer.call
+
+    def recompute_call(*args, **kwargs):
+        # Custom gradients only take keyword arguments in eager mode, they are
+        # bound outside. They carry masks and flags, no gradient
+        return tf.recompute_grad(lambda *inputs: call(*inputs, **kwargs))(*args)
+
+    layer.call = recompute_call
+    return layer
@@ -29,27 +29,65 @@ def parse_arguments():
     parser.add_argument("--plot_folder", default="../plots", help="Folder to save the outputs")
     parser.add_argument("--val_file", default="val_ggF", help="Folder to save the outputs")
     parser.add_argument("--corrector", action='store_true', default=False, help='Learn a linear correction to generated events')
+    parser.add_argument("--sampler", default=None, help='Sampler used to generate events: ddpm, ddim or dpm. Defaults to ddpm, ddim with --distilled')
+    parser.add_argument("--evt_steps", type=int, default=None, help='Number of event sampler steps, defaults to the model setting')
+    parser.add_argument("--part_steps", type=int, default=None, help='Number of particle sampler steps, defaults to the model setting')
+    parser.add_argument("--distilled", action='store_true', default=False, help='Load the model distilled to evt_steps and part_steps, 8 and 8 by default as train.py --distill, sampled with ddim by default')
+    parser.add_argument("--precision", default="float32", help="Mixed precision policy, e.g. mixed_bfloat16 or mixed_float16")
+    parser.add_argument("--jit", action='store_true', default=False, help='Compile the sampler loops with XLA')
+    parser.add_argument("--time_tables", action='store_true', default=False, help='Precompute the time conditioning of all sampler steps per split')
 
     parser.add_argument("--name", default="parnassus", help="File to save the outputs")
     
+    parser.add_argument("--mask_attention", action='store_true', default=False, help='Mask padded particles in the body attention')
+    parser.add_argument("--attention_block", type=int, default=None, help='Drop trailing blocks of this many padded slots in the masked attention')
+    parser.add_argument("--latent_attention", type=int, default=0, help='Number of learned latent tokens replacing the body self-attention, 0 for full attention')
+    parser.add_argument("--cross_attention", action='store_true', default=False, help='Reco particles cross-attend to a separate gen encoder instead of a joint self-attention')
+    parser.add_argument("--cell_knn", action='store_true', default=False, help='First local layer uses gen neighbors in eta-phi from a cell list built by the data loader')
+    parser.add_argument("--split_size", type=int, default=None, help='Events per generate split instead of 200 splits')
+    parser.add_argument("--memory_budget", type=float, default=None, help='GiB per generate split, the split size follows from the model size')
+    parser.add_argument("--trim_block", type=int, default=None, help='Sample the particles sorted by multiplicity, trimmed to multiples of this many slots. Needs --mask_attention')
+    parser.add_argument("--pipeline", action='store_true', default=False, help='Prepare the events of the next split on a worker thread while sampling the particles')
+    parser.add_argument("--ema_only", action='store_true', default=False, help='Load the EMA weights saved by train.py --ema_only')
     parser.add_argument("--K", type=int, default=5, help="K neighbors")
     parser.add_argument("--num_local", type=int, default=1, help="number of local layers for knn")    
     parser.add_argument("--num_layers", type=int, default=8, help="Number of transformer layers")
     parser.add_argument("--projection", type=int, default=128, help="base projection size")
 
-    return parser.parse_args()
+    flags = parser.parse_args()
+    if flags.sampler is None:
+        #Students are distilled to match DDIM steps
+        flags.sampler = 'ddim' if flags.distilled else 'ddpm'
+    if flags.distilled:
+        #Steps of the last round of train.py --distill unless given
+        flags.evt_steps = 8 if flags.evt_steps is None else flags.evt_steps
+        flags.part_steps = 8 if flags.part_steps is None else flags.part_steps
+    return flags
 
 def get_data_info(flags):
     test = utils.DataLoader(os.path.join(flags.folder),
                             names = [flags.val_file],
                             batch_size = flags.batch,
-                            rank = hvd.rank(), size = hvd.size())
+                            rank = hvd.rank(), size = hvd.size(),
+                            cell_knn = flags.K if flags.cell_knn else 0)
     return test
 
-def get_model_name(flags,corrector=False):
+def get_model_name(flags,corrector=False,distilled=False):
     model_name = f'parnassus_qcd_{flags.K}_{flags.num_local}_{flags.num_layers}_{flags.projection}.weights.h5'
+    if getattr(flags,'mask_attention',False):
+        model_name = model_name.replace('.weights.h5','_masked.weights.h5')
+    if getattr(flags,'cell_knn',False):
+        model_name = model_name.replace('.weights.h5','_cells.weights.h5')
+    if getattr(flags,'cross_attention',False):
+        model_name = model_name.replace('.weights.h5','_cross.weights.h5')
+    if getattr(flags,'latent_attention',0):
+        model_name = model_name.replace('.weights.h5',f'_latent{flags.latent_attention}.weights.h5')
     if corrector:
         model_name = f'parnassus_qcd_{flags.K}_{flags.num_local}_{flags.num_layers}_{flags.projection}_corrector.weights.h5'
+    elif distilled:
+        model_name = model_name.replace('.weights.h5',f'_distill_{flags.evt_steps}_{flags.part_steps}.weights.h5')
+    if getattr(flags,'ema_only',False) and not corrector:
+        model_name = model_name.replace('.weights.h5','_ema.weights.h5')
     return model_name
 
 
@@ -63,11 +101,19 @@ def load_data_and_model(flags):
                 K = flags.K,
                 num_layers = flags.num_layers,
                 num_local = flags.num_local,
+                mask_attention = flags.mask_attention,
+                attention_block = flags.attention_block,
+                cell_knn = flags.cell_knn,
+                cross_attention = flags.cross_attention,
+                latent_attention = flags.latent_attention,
                 )
     
-    model_name = os.path.join(flags.folder, 'checkpoints', get_model_name(flags))
+    model_name = os.path.join(flags.folder, 'checkpoints', get_model_name(flags,distilled=flags.distilled))
     print(f"loading model {model_name}")
-    model.load_weights(model_name)
+    if flags.ema_only:
+        model.ema_weights().load_weights(model_name)
+    else:
+        model.load_weights(model_name)
     
 
     if flags.corrector:
@@ -94,7 +140,20 @@ def sample_data(test, model,corrector, flags, sample_name):
     nsplit = 200
     gen_part,gen_mask,gen_evt,evtn = test.get_preprocess_cond(flags.nevts)
     p, j = model.generate(gen_part,gen_mask,gen_evt,
-                          nsplit=nsplit,use_tqdm=hvd.rank()==0)
+                          nsplit=nsplit,use_tqdm=hvd.rank()==0,
+                          time_tables=flags.time_tables,
+                          sampler=flags.sampler,
+                          evt_steps=flags.evt_steps,
+                          part_steps=flags.part_steps,
+                          jit_compile=flags.jit,
+                          gen_knn=test.gen_knn if flags.cell_knn else None,
+                          batch_size=flags.split_size,
+                          memory_budget=None if flags.memory_budget is None else flags.memory_budget*2**30,
+                          trim_block=flags.trim_block,
+                          pipeline=flags.pipeline)
+    if hvd.rank()==0:
+        seconds = sum(stats['seconds'] for stats in model.split_stats)
+        logger.info(f"Sampled {j.shape[0]} events in {len(model.split_stats)} splits, {j.shape[0]/seconds:.1f} events/s")
 
     if corrector is not None:
         p = corrector.predict([p,gen_part,
@@ -205,6 +264,7 @@ def main():
     utils.setup_gpus()
     if hvd.rank()==0:logging.info("Horovod and GPUs initialized successfully.")
     flags = parse_arguments()
+    tf.keras.mixed_precision.set_global_policy(flags.precision)
     sample_name = os.path.join(flags.folder, f'{flags.name}.h5')
     
     if flags.sample:
@@ -11,14 +11,11 @@ from wandb.integration.keras import WandbMetricsLogger
 
 # Custom local imports
 import utils
-from PET import PET,PETCorrector
+from PET import PET,PETCorrector,PETDistill,GradientAllreduce
 
 # Keras imports
 from tensorflow.keras.optimizers import schedules, Lion
-from tensorflow.keras.callbacks import ModelCheckpoint, ReduceLROnPlateau, EarlyStopping
-
-# Initialize Horovod
-hvd.init()
+from tensorflow.keras.callbacks import ReduceLROnPlateau, EarlyStopping
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -29,8 +26,19 @@ def get_model_name(flags):
         model_name = f'parnassus_qcd_{flags.K}_{flags.num_local}_{flags.num_layers}_{flags.projection}_corrector.weights.h5'
     else:
         model_name = f'parnassus_qcd_{flags.K}_{flags.num_local}_{flags.num_layers}_{flags.projection}.weights.h5'
+        if flags.mask_attention:
+            model_name = model_name.replace('.weights.h5','_masked.weights.h5')
+        if flags.cell_knn:
+            model_name = model_name.replace('.weights.h5','_cells.weights.h5')
+        if flags.cross_attention:
+            model_name = model_name.replace('.weights.h5','_cross.weights.h5')
+        if flags.latent_attention:
+            model_name = model_name.replace('.weights.h5',f'_latent{flags.latent_attention}.weights.h5')
     return model_name
 
+def get_distill_name(flags,evt_steps,part_steps):
+    return get_model_name(flags).replace('.weights.h5',f'_distill_{evt_steps}_{part_steps}.weights.h5')
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Train the PET model.")
     parser.add_argument("--dataset", type=str, default="parnassus", help="Dataset to use")
@@ -42,7 +50,32 @@ def parse_arguments():
     parser.add_argument("--fine_tune", action='store_true', default=False, help='Fine tune a model')
     parser.add_argument("--corrector", action='store_true', default=False, help='Learn a linear correction to generated events')
     parser.add_argument("--load", action='store_true', help="Continue the training")
+    parser.add_argument("--precision", default="float32", help="Mixed precision policy, e.g. mixed_bfloat16 or mixed_float16")
+    parser.add_argument("--jit", action='store_true', default=False, help='Compile train_step and test_step with XLA')
+    parser.add_argument("--distill", action='store_true', default=False, help='Progressive distillation of the trained model')
+    parser.add_argument("--distill_evt_steps", type=int, default=8, help='Number of event sampler steps of the last distillation round')
+    parser.add_argument("--distill_part_steps", type=int, default=8, help='Number of particle sampler steps of the last distillation round')
     
+    parser.add_argument("--mask_attention", action='store_true', default=False, help='Mask padded particles in the body attention')
+    parser.add_argument("--attention_block", type=int, default=None, help='Drop trailing blocks of this many padded slots in the masked attention')
+    parser.add_argument("--latent_attention", type=int, default=0, help='Number of learned latent tokens replacing the body self-attention, 0 for full attention')
+    parser.add_argument("--cross_attention", action='store_true', default=False, help='Reco particles cross-attend to a separate gen encoder instead of a joint self-attention')
+    parser.add_argument("--cell_knn", action='store_true', default=False, help='First local layer uses gen neighbors in eta-phi from a cell list built by the data loader')
+    parser.add_argument("--recompute", action='store_true', default=False, help='Recompute the attention and MLP activations of the body in the backward pass to save memory, the checkpoints are the same as without')
+    parser.add_argument("--ema_interval", type=int, default=1, help='Update the EMA weights every this many steps')
+    parser.add_argument("--accum_steps", type=int, default=1, help='Number of batches whose gradients are accumulated per optimizer update')
+    parser.add_argument("--keep_checkpoints", type=int, default=0, help='Also keep the last this many checkpoints with an _epoch suffix')
+    parser.add_argument("--ema_only", action='store_true', default=False, help='Checkpoint only the EMA weights used for sampling')
+    parser.add_argument("--ema_device", type=str, default=None, help='Device of the EMA weights, e.g. /CPU:0')
+    parser.add_argument("--grad_compression", default="none", choices=['none','fp16'], help='Compression of the gradients in the Horovod allreduce')
+    parser.add_argument("--grad_predivide", type=float, default=1.0, help='Divide the gradients by this factor before the allreduce sum, e.g. the number of ranks to avoid fp16 overflows')
+    parser.add_argument("--fused_allreduce", action='store_true', default=False, help='Reduce the body and head gradients in a single fused allreduce')
+    parser.add_argument("--fusion_threshold", type=int, default=None, help='Horovod tensor fusion buffer in MiB, should hold the gradients of the fused allreduce')
+    parser.add_argument("--cycle_time", type=float, default=None, help='Horovod cycle time in ms')
+    parser.add_argument("--timing", type=int, default=0, help='Log the step time, throughput and train_step component times every this many steps, 0 to disable')
+    parser.add_argument("--timing_file", type=str, default=None, help='JSONL file for the --timing windows, they also go to the epoch logs')
+    parser.add_argument("--profile_steps", type=int, nargs=2, default=None, help='Capture a tf.profiler trace from the first to the second train step')
+    parser.add_argument("--profile_dir", type=str, default='profile', help='Log directory of the tf.profiler trace')
     parser.add_argument("--K", type=int, default=3, help="K neighbors")
     parser.add_argument("--num_local", type=int, default=1, help="number of local layers for knn")    
     parser.add_argument("--num_layers", type=int, default=6, help="Number of transformer layers")
@@ -56,8 +89,9 @@ def configure_optimizers(flags, train_loader,lr_factor = 1.0):
     lr_schedule = schedules.CosineDecay(
         initial_learning_rate=flags.lr/lr_factor,
         warmup_target=scale_lr/lr_factor,
-        warmup_steps=3*train_loader.nevts//flags.batch//hvd.size(),
-        decay_steps=flags.epoch*train_loader.nevts//flags.batch//hvd.size(),
+        #the schedule counts optimizer updates, one every accum_steps batches
+        warmup_steps=3*train_loader.nevts//flags.batch//hvd.size()//flags.accum_steps,
+        decay_steps=flags.epoch*train_loader.nevts//flags.batch//hvd.size()//flags.accum_steps,
     )
     optimizer = Lion(
         learning_rate=lr_schedule,
@@ -66,11 +100,119 @@ def configure_optimizers(flags, train_loader,lr_factor = 1.0):
         beta_2=0.99,
         weight_decay = 1e-2
     )
-    return hvd.DistributedOptimizer(optimizer)
+    #The gradients are averaged over the ranks by the GradientAllreduce given to compile
+    return optimizer
+
+def model_kwargs(flags,loader):
+    """Arguments of PET, shared by the trained and the distilled models"""
+    return dict(num_feat=loader.num_feat,
+                num_evt=loader.num_evt,
+                num_part=loader.num_part,
+                projection_dim = flags.projection,
+                K = flags.K,
+                num_layers = flags.num_layers,
+                num_local = flags.num_local,
+                mask_attention = flags.mask_attention,
+                attention_block = flags.attention_block,
+                cell_knn = flags.cell_knn,
+                cross_attention = flags.cross_attention,
+                latent_attention = flags.latent_attention,
+                ema_device = flags.ema_device,
+                recompute = flags.recompute,
+                )
+
+def train_model(model,flags,train_loader,val_loader,checkpoint_name,build=None):
+    optimizer_body = configure_optimizers(flags, train_loader, lr_factor=flags.lr_factor if flags.fine_tune else 1)
+    optimizer_head = configure_optimizers(flags, train_loader)
+    #Body and head gradients are reduced together, fused in a single allreduce with --fused_allreduce
+    allreduce = GradientAllreduce(flags.grad_compression, flags.grad_predivide, flags.fused_allreduce)
+    if flags.corrector:
+        model.compile(optimizer_body, optimizer_head, jit_compile=flags.jit, accum_steps=flags.accum_steps,
+                      allreduce=allreduce)
+    else:
+        model.compile(optimizer_body, optimizer_head, jit_compile=flags.jit,
+                      ema_interval=flags.ema_interval, accum_steps=flags.accum_steps,
+                      instrument=flags.timing > 0, allreduce=allreduce)
+
+    callbacks = [
+        hvd.callbacks.BroadcastGlobalVariablesCallback(0),
+        hvd.callbacks.MetricAverageCallback(),
+        EarlyStopping(patience=200, restore_best_weights=True),
+        ReduceLROnPlateau(monitor='val_loss', patience=300, min_lr=1e-6)
+    ]
+
+    if hvd.rank() == 0:
+        if flags.timing > 0 or flags.profile_steps is not None:
+            #After MetricAverageCallback, the timing logs only exist on rank 0
+            callbacks.append(utils.StepTimeLogger(flags.timing, jsonl=flags.timing_file,
+                                                  profile_steps=flags.profile_steps,
+                                                  profile_dir=flags.profile_dir))
+        checkpoint_path = os.path.join(flags.folder, 'checkpoints', checkpoint_name)
+        saveable = None
+        if flags.ema_only and not flags.corrector:
+            checkpoint_path = checkpoint_path.replace('.weights.h5','_ema.weights.h5')
+            saveable = lambda model: model.ema_weights()
+        #Serialized from a host copy on a background thread, the other ranks do not wait for it
+        with tf.device('/CPU:0'):
+            shadow = build() if build is not None else None
+        checkpoint_callback = utils.AsyncCheckpoint(checkpoint_path,
+                                                    save_best_only=True,
+                                                    keep=flags.keep_checkpoints,
+                                                    saveable=saveable,
+                                                    shadow=shadow)
+        callbacks.append(checkpoint_callback)
+        callbacks.append(WandbMetricsLogger())
+        
+
+    hist = model.fit(train_loader.make_tfdata(),
+                     epochs=flags.epoch,
+                     validation_data=val_loader.make_tfdata(),
+                     batch_size=flags.batch,
+                     callbacks=callbacks,
+                     steps_per_epoch=train_loader.steps_per_epoch,
+                     validation_steps=val_loader.steps_per_epoch,
+                     verbose=hvd.rank() == 0)
+    return hist
+
+def distill(model,flags,train_loader,val_loader):
+    """Halve the sampler steps of the trained model every round until the
+    requested number of steps is reached"""
+    model_path = os.path.join(flags.folder, 'checkpoints', get_model_name(flags))
+    if flags.ema_only:
+        #Only the EMA copies were saved, the student starts from them
+        model_path = model_path.replace('.weights.h5','_ema.weights.h5')
+    logger.info(f"Loading teacher weights from {model_path}")
+    if flags.ema_only:
+        model.ema_weights().load_weights(model_path)
+    else:
+        model.load_weights(model_path)
+
+    teacher = model
+    teacher_sampler = 'ddpm'
+    while teacher.num_steps_evt > flags.distill_evt_steps or teacher.num_steps > flags.distill_part_steps:
+        evt_steps = max(teacher.num_steps_evt//2,flags.distill_evt_steps)
+        part_steps = max(teacher.num_steps//2,flags.distill_part_steps)
+        logger.info(f"Distilling {teacher.num_steps_evt}/{teacher.num_steps} into {evt_steps}/{part_steps} steps")
+        student = PETDistill(teacher,evt_steps,part_steps,
+                             teacher_sampler = teacher_sampler,
+                             **model_kwargs(flags,train_loader))
+        #The student checkpoint loads into a plain PET
+        train_model(student,flags,train_loader,val_loader,get_distill_name(flags,evt_steps,part_steps),
+                    build=lambda: PET(**model_kwargs(flags,train_loader)))
+        student.set_teacher(None)
+        #Distilled models are sampled with DDIM
+        teacher = student
+        teacher_sampler = 'ddim'
 
 def main():
-    utils.setup_gpus()
     flags = parse_arguments()
+    #Horovod reads the tensor fusion settings in init
+    if flags.fusion_threshold is not None:
+        os.environ['HOROVOD_FUSION_THRESHOLD'] = str(flags.fusion_threshold*2**20)
+    if flags.cycle_time is not None:
+        os.environ['HOROVOD_CYCLE_TIME'] = str(flags.cycle_time)
+    utils.setup_gpus()
+    tf.keras.mixed_precision.set_global_policy(flags.precision)
 
     if flags.corrector:
         train_loader = utils.DataLoader(os.path.join(flags.folder),
@@ -88,11 +230,13 @@ def main():
         train_loader = utils.DataLoader(os.path.join(flags.folder,'h5'),
                                         names = ['top','qcd_400','qcd_600'],
                                         batch_size = flags.batch,
-                                        rank = hvd.rank(), size = hvd.size())
+                                        rank = hvd.rank(), size = hvd.size(),
+                                        cell_knn = flags.K if flags.cell_knn else 0)
         val_loader = utils.DataLoader(os.path.join(flags.folder,'h5'),
                                       names = ['ggF'],
                                       batch_size = flags.batch,
-                                      rank = hvd.rank(), size = hvd.size())
+                                      rank = hvd.rank(), size = hvd.size(),
+                                      cell_knn = flags.K if flags.cell_knn else 0)
 
         
     if flags.fine_tune:
@@ -123,24 +267,22 @@ def main():
 
 
     if flags.corrector:
-        model = PETCorrector(num_feat=train_loader.num_feat,
-                             projection_dim = flags.projection,
-                             K = flags.K,
-                             num_layers = flags.num_layers,
-                             num_local = flags.num_local,
-                             #Corrector learns a linear combination of the outputs ax+b
-                             )
+        build = lambda: PETCorrector(num_feat=train_loader.num_feat,
+                                     projection_dim = flags.projection,
+                                     K = flags.K,
+                                     num_layers = flags.num_layers,
+                                     num_local = flags.num_local,
+                                     #Corrector learns a linear combination of the outputs ax+b
+                                     )
 
     else:
-        model = PET(num_feat=train_loader.num_feat,
-                    num_evt=train_loader.num_evt,
-                    num_part=train_loader.num_part,
-                    projection_dim = flags.projection,
-                    K = flags.K,
-                    num_layers = flags.num_layers,
-                    num_local = flags.num_local,
-                    )
+        build = lambda: PET(**model_kwargs(flags,train_loader))
+    model = build()
 
+    if flags.distill:
+        distill(model,flags,train_loader,val_loader)
+        return
+    
     if flags.load:
         if hvd.rank()==0:
             model_name = get_model_name(flags)
@@ -148,38 +290,8 @@ def main():
             logger.info(f"Loading model weights from {model_path}")
             model.load_weights(model_path,by_name=True,skip_mismatch=True)
 
-    
-    optimizer_body = configure_optimizers(flags, train_loader, lr_factor=flags.lr_factor if flags.fine_tune else 1)
-    optimizer_head = configure_optimizers(flags, train_loader)
-    model.compile(optimizer_body, optimizer_head)
-
-    callbacks = [
-        hvd.callbacks.BroadcastGlobalVariablesCallback(0),
-        hvd.callbacks.MetricAverageCallback(),
-        EarlyStopping(patience=200, restore_best_weights=True),
-        ReduceLROnPlateau(monitor='val_loss', patience=300, min_lr=1e-6)
-    ]
-
-    if hvd.rank() == 0:
-        checkpoint_name = get_model_name(flags)
-        checkpoint_path = os.path.join(flags.folder, 'checkpoints', checkpoint_name)
-        checkpoint_callback = ModelCheckpoint(checkpoint_path,
-                                              save_best_only=True, mode='auto',
-                                              save_weights_only=True,
-                                              period=1)
-        callbacks.append(checkpoint_callback)
-        callbacks.append(WandbMetricsLogger())
-        
-
-    hist = model.fit(train_loader.make_tfdata(),
-                     epochs=flags.epoch,
-                     validation_data=val_loader.make_tfdata(),
-                     batch_size=flags.batch,
-                     callbacks=callbacks,
-                     steps_per_epoch=train_loader.steps_per_epoch,
-                     validation_steps=val_loader.steps_per_epoch,
-                     verbose=hvd.rank() == 0)
 
+    train_model(model,flags,train_loader,val_loader,get_model_name(flags),build=build)
 
 if __name__ == "__main__":
     main()
@@ -7,7 +7,10 @@ import tensorflow as tf
 import gc
 import random
 import itertools
-import pickle, copy
+import time
+import pickle, copy, json
+import shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
 from scipy.stats import norm
 import horovod.tensorflow.keras as hvd
 
@@ -31,10 +34,68 @@ def revert_npart(nparts):
     std = np.array([0.542, 0.455, 12.5, 8.39, 31.4])
     return np.round(nparts * std + mean).astype(np.int32)
 
+def cell_neighbors(eta, phi, mask, K, cell_size=None):
+    """Indices (P,K) of the K nearest real particles of each real particle of an
+    event in (eta, phi), with phi periodic, found with a cell list. Only the 3x3
+    cells around a particle are searched, particles whose K-th neighbor may lie
+    further out fall back to the full search. The particle itself is included,
+    as in the dense search. Padded particles, and missing neighbors when the
+    event has less than K particles, point at the particle itself.
+    cell_size defaults to cells holding about K particles."""
+    num_part = eta.shape[0]
+    indices = np.tile(np.arange(num_part, dtype=np.int32)[:, None], (1, K))
+    real = np.flatnonzero(mask)
+    nreal = real.shape[0]
+    if nreal == 0:
+        return indices
+    k = min(K, nreal)
+    eta = eta[real]
+    phi = np.mod(phi[real] + np.pi, 2*np.pi)
+    if cell_size is None:
+        cell_size = np.sqrt(max(np.ptp(eta), 1.0)*2*np.pi*K/nreal)
+    #At least 3 phi cells so the wrapped 3x3 window has no repeated cells
+    nphi = max(int(2*np.pi//cell_size), 3)
+    ieta = ((eta - eta.min())//cell_size).astype(int)
+    iphi = np.minimum((phi//(2*np.pi/nphi)).astype(int), nphi - 1)
+    neta = ieta.max() + 1
+
+    #Particles of each cell, padded with -1. The last row is an empty cell
+    #used for the window cells outside the eta range
+    cell = ieta*nphi + iphi
+    order = np.argsort(cell, kind='stable')
+    counts = np.bincount(cell, minlength=neta*nphi)
+    slot = np.arange(nreal) - (np.cumsum(counts) - counts)[cell[order]]
+    table = -np.ones((neta*nphi + 1, counts.max()), dtype=int)
+    table[cell[order], slot] = order
+
+    def distance(i, j):
+        dphi = np.abs(phi[i] - phi[j])
+        dphi = np.minimum(dphi, 2*np.pi - dphi)
+        return (eta[i] - eta[j])**2 + dphi**2
+
+    deta, dphi = [d.reshape(-1) for d in np.meshgrid([-1, 0, 1], [-1, 0, 1], indexing='ij')]
+    window_eta = ieta[:, None] + deta
+    window = np.where((window_eta >= 0) & (window_eta < neta),
+                      window_eta*nphi + np.mod(iphi[:, None] + dphi, nphi), neta*nphi)
+    candidates = table[window].reshape(nreal, -1)
+    dist = np.where(candidates >= 0,
+                    distance(np.arange(nreal)[:, None], np.maximum(candidates, 0)), np.inf)
+    nearest = np.argsort(dist, -1, kind='stable')[:, :k]
+    neighbors = np.take_along_axis(candidates, nearest, -1)
+
+    #Particles outside the window are at least cell_size away
+    missed = np.take_along_axis(dist, nearest[:, -1:], -1)[:, 0] > cell_size**2
+    if np.any(missed):
+        dist = distance(np.flatnonzero(missed)[:, None], np.arange(nreal)[None])
+        neighbors[missed] = np.argsort(dist, -1, kind='stable')[:, :k]
+
+    indices[real, :k] = real[neighbors]
+    return indices
+
 
 class DataLoader:
     """Base class for all data loaders with common preprocessing methods."""
-    def __init__(self, path, names = [], correction = [], reference = [], batch_size=512, rank=0, size=1, chunk_size=5000,corrector = False,**kwargs):
+    def __init__(self, path, names = [], correction = [], reference = [], batch_size=512, rank=0, size=1, chunk_size=5000,corrector = False,cell_knn=0,**kwargs):
 
         self.path = path
         self.batch_size = batch_size
@@ -45,6 +106,9 @@ class DataLoader:
         self.reference = reference
 
         self.corrector = corrector
+        #Number of eta-phi neighbors of the gen particles added as input_gen_knn, 0 to skip
+        self.cell_knn = cell_knn
+        self.reset_stats()
         if self.corrector:
             assert len(self.correction) > 0 and len(self.reference) > 0, "ERROR: Reference and Correction not given"
         
@@ -112,6 +176,8 @@ class DataLoader:
             
         gen = self.preprocess(self.gen,self.gen_mask).astype(np.float32)
         gen_evt = self.preprocess_evt(self.gen_evt).astype(np.float32)
+        if self.cell_knn:
+            self.gen_knn = self.get_cell_knn(self.gen,self.gen_mask)
         return gen, self.gen_mask.astype(np.float32), gen_evt, evtn.astype(np.int32)
 
         
@@ -142,6 +208,11 @@ class DataLoader:
         new_features[np.isinf(new_features)] = 0.0
         return new_features
 
+    def get_cell_knn(self,x,mask):
+        #Eta-phi neighbors of every event, computed on the unprocessed particles
+        return np.stack([cell_neighbors(x[i,:,0],x[i,:,1],mask[i],self.cell_knn)
+                         for i in range(x.shape[0])]).astype(np.int32)
+
     def preprocess_evt(self,x):
         new_features = (x-self.mean_evt)/self.std_evt
         new_features[np.isnan(new_features)] = 0.0
@@ -174,34 +245,47 @@ class DataLoader:
 
 
 
+    def read_chunk(self, file, start, end):
+        t0 = time.perf_counter()
+        chunk = {'reco': file['reco'][start:end].astype(np.float32),
+                 'gen': file['gen'][start:end].astype(np.float32),
+                 'reco_evt': file['reco_evt'][start:end],
+                 'gen_evt': file['gen_evt'][start:end]}
+        self.stage_time['read'] += time.perf_counter() - t0
+        self.bytes_read += sum(v.nbytes for v in chunk.values())
+        return chunk
+
+    def preprocess_chunk(self, chunk):
+        t0 = time.perf_counter()
+        reco_mask_chunk = chunk['reco'][:, :, 2] != 0
+        gen_mask_chunk = chunk['gen'][:, :, 2] != 0
+
+        processed = {
+            'input_reco': self.preprocess(chunk['reco'], reco_mask_chunk).astype(np.float32),
+            'input_gen': self.preprocess(chunk['gen'], gen_mask_chunk).astype(np.float32),
+            'input_reco_mask': reco_mask_chunk,
+            'input_gen_mask': gen_mask_chunk,
+            'input_reco_evt': self.preprocess_evt(chunk['reco_evt']).astype(np.float32),
+            'input_gen_evt': self.preprocess_evt(chunk['gen_evt']).astype(np.float32)}
+        if self.cell_knn:
+            processed['input_gen_knn'] = self.get_cell_knn(chunk['gen'],gen_mask_chunk)
+        self.stage_time['preprocess'] += time.perf_counter() - t0
+        return processed
+
+    def reset_stats(self):
+        # Accumulated wall time per host-side stage and raw bytes read from disk
+        self.stage_time = {'read': 0.0, 'preprocess': 0.0}
+        self.bytes_read = 0
+
     def single_file_generator(self, file_path):
         with h5.File(file_path, 'r') as file:
             data_size = file['reco_evt'].shape[0]
             for start in range(0, data_size, self.chunk_size):
                 end = min(start + self.chunk_size, data_size)
-                
-                reco_chunk = file['reco'][start:end].astype(np.float32)
-                gen_chunk = file['gen'][start:end].astype(np.float32)
-                reco_evt_chunk = file['reco_evt'][start:end]
-                gen_evt_chunk = file['gen_evt'][start:end]
-                reco_mask_chunk = reco_chunk[:, :, 2] != 0
-                gen_mask_chunk = gen_chunk[:, :, 2] != 0  
-                
-                reco_chunk = self.preprocess(reco_chunk, reco_mask_chunk).astype(np.float32)
-                gen_chunk = self.preprocess(gen_chunk, gen_mask_chunk).astype(np.float32)
-                
-                reco_evt_chunk = self.preprocess_evt(reco_evt_chunk).astype(np.float32)
-                gen_evt_chunk = self.preprocess_evt(gen_evt_chunk).astype(np.float32)
-
-                for j in range(reco_chunk.shape[0]):                        
-                    yield {
-                        'input_reco': reco_chunk[j],
-                        'input_gen': gen_chunk[j],
-                        'input_reco_mask': reco_mask_chunk[j],
-                        'input_gen_mask': gen_mask_chunk[j],
-                        'input_reco_evt': reco_evt_chunk[j],
-                        'input_gen_evt': gen_evt_chunk[j]}
-                
+                chunk = self.preprocess_chunk(self.read_chunk(file, start, end))
+                for j in range(end - start):
+                    yield {key: value[j] for key, value in chunk.items()}
+
     def interleaved_file_generator(self):
         random.shuffle(self.files)
         generators = [self.single_file_generator(fp) for fp in self.files]
@@ -214,8 +298,8 @@ class DataLoader:
             except StopIteration:
                 break
 
-    def make_tfdata(self):
-
+    def make_dataset(self):
+        """Unbatched, unshuffled dataset of single events."""
         if self.corrector:
             reco_data,gen_data,reco_mask,gen_mask,_, _ = self.data_from_file(self.correction, preprocess=True)
             label = self.data_from_file(self.reference, preprocess=True)[0]
@@ -228,16 +312,196 @@ class DataLoader:
                  })
                     
         else:
+            signature = {'input_reco': tf.TensorSpec(shape=(self.num_part, self.num_feat), dtype=tf.float32),
+                         'input_gen': tf.TensorSpec(shape=(self.num_part, self.num_feat), dtype=tf.float32),                 
+                         'input_reco_mask': tf.TensorSpec(shape=(self.num_part), dtype=tf.float32),
+                         'input_gen_mask': tf.TensorSpec(shape=(self.num_part), dtype=tf.float32),
+                         'input_reco_evt': tf.TensorSpec(shape=(self.num_evt), dtype=tf.float32),
+                         'input_gen_evt': tf.TensorSpec(shape=(self.num_evt), dtype=tf.float32)}
+            if self.cell_knn:
+                signature['input_gen_knn'] = tf.TensorSpec(shape=(self.num_part, self.cell_knn), dtype=tf.int32)
             dataset = tf.data.Dataset.from_generator(
                 self.interleaved_file_generator,
-                output_signature=(
-                    {'input_reco': tf.TensorSpec(shape=(self.num_part, self.num_feat), dtype=tf.float32),
-                     'input_gen': tf.TensorSpec(shape=(self.num_part, self.num_feat), dtype=tf.float32),                 
-                     'input_reco_mask': tf.TensorSpec(shape=(self.num_part), dtype=tf.float32),
-                     'input_gen_mask': tf.TensorSpec(shape=(self.num_part), dtype=tf.float32),
-                     'input_reco_evt': tf.TensorSpec(shape=(self.num_evt), dtype=tf.float32),
-                     'input_gen_evt': tf.TensorSpec(shape=(self.num_evt), dtype=tf.float32)}
-                ))
-        
+                output_signature=(signature))
+        return dataset
+
+    def make_tfdata(self):
+        dataset = self.make_dataset()
         return dataset.shuffle(self.batch_size*50).repeat().batch(self.batch_size).prefetch(tf.data.AUTOTUNE)
-        
+
+def make_synthetic_files(folder, nfiles=2, nevts=10000, num_part=200, num_feat=12, num_evt=8,
+                         num_pid=5, mean_mult=30, name='synthetic', seed=0):
+    """Write random events with the same h5 layout as the training files.
+    Used to exercise the input pipeline and samplers without the NERSC data."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    def make_particles(nparts):
+        parts = np.zeros((nparts.shape[0], num_part, num_feat), dtype=np.float32)
+        mask = np.arange(num_part)[None, :] < nparts[:, None]
+        parts[:, :, 0] = rng.normal(0, 1.5, mask.shape)
+        parts[:, :, 1] = rng.uniform(-np.pi, np.pi, mask.shape)
+        parts[:, :, 2] = -rng.exponential(1.0, mask.shape) - 1e-3
+        parts[:, :, 3:6] = rng.normal(0, 0.5, mask.shape + (3,))
+        pid = rng.integers(0, num_pid, mask.shape)
+        parts[:, :, num_feat - num_pid:] = np.eye(num_pid, dtype=np.float32)[pid]
+        return parts * mask[:, :, None]
+
+    def make_evt(parts):
+        evt = np.zeros((parts.shape[0], num_evt), dtype=np.float32)
+        evt[:, :3] = rng.normal(0, 10, (parts.shape[0], 3))
+        evt[:, 2] = np.abs(evt[:, 2]) + 100
+        evt[:, 3:3 + num_pid] = np.sum(parts[:, :, num_feat - num_pid:], 1)[:, :num_evt - 3]
+        return evt
+
+    files = []
+    for ifile in range(nfiles):
+        ngen = np.clip(rng.poisson(mean_mult, nevts), 1, num_part)
+        nreco = np.clip(ngen + rng.integers(-3, 4, nevts), 1, num_part)
+        gen, reco = make_particles(ngen), make_particles(nreco)
+        file_name = os.path.join(folder, f'{name}_{ifile}.h5')
+        with h5.File(file_name, 'w') as fh5:
+            fh5.create_dataset('reco', data=reco)
+            fh5.create_dataset('gen', data=gen)
+            fh5.create_dataset('reco_evt', data=make_evt(reco))
+            fh5.create_dataset('gen_evt', data=make_evt(gen))
+            fh5.create_dataset('eventNumber', data=np.arange(ifile*nevts, (ifile + 1)*nevts))
+        files.append(file_name)
+    return files
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    """Saves the weights of the best epoch without stalling the other ranks:
+    the weights are copied into shadow, a host copy of the model built with
+    the same arguments, and a background thread serializes it with
+    save_weights to host memory (/dev/shm), copies the file next to filepath
+    and renames it over the previous checkpoint. Without shadow, save_weights
+    runs on the training thread and only the copy is in the background.
+    keep > 0 also keeps the last keep checkpoints with an _epoch suffix.
+    saveable picks what to save, e.g. only the EMA weights. The checkpoint is
+    a single file, not sharded: every Horovod rank holds the same weights and
+    load_weights reads one file."""
+    def __init__(self, filepath, monitor='val_loss', save_best_only=True, keep=0, saveable=None, shadow=None):
+        super().__init__()
+        self.filepath = filepath
+        self.monitor = monitor
+        self.save_best_only = save_best_only
+        self.keep = keep
+        self.saveable = saveable if saveable is not None else (lambda model: model)
+        self.shadow = shadow
+        self.best = np.inf
+        self.kept = []
+        self.pending = None
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.staging = tempfile.mkdtemp(prefix='checkpoint_',
+                                        dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+    def on_epoch_end(self, epoch, logs=None):
+        current = (logs or {}).get(self.monitor)
+        if self.save_best_only:
+            if current is None or current >= self.best:
+                return
+            self.best = current
+        #One write in flight, also raises errors of the previous write
+        self.wait()
+        staged = os.path.join(self.staging, f'epoch{epoch + 1}.weights.h5')
+        if self.shadow is None:
+            self.saveable(self.model).save_weights(staged)
+            self.pending = self.writer.submit(self.write, staged, epoch + 1)
+        else:
+            #Only the host copy blocks, save_weights takes several times longer
+            self.saveable(self.shadow).set_weights(self.saveable(self.model).get_weights())
+            self.pending = self.writer.submit(self.write, staged, epoch + 1, self.saveable(self.shadow))
+
+    def write(self, staged, epoch, model=None):
+        if model is not None:
+            model.save_weights(staged)
+        targets = [self.filepath]
+        if self.keep > 0:
+            targets.append(self.filepath.replace('.weights.h5', f'_epoch{epoch}.weights.h5'))
+        for target in targets:
+            shutil.copyfile(staged, target + '.tmp')
+            os.replace(target + '.tmp', target)
+        os.remove(staged)
+        if self.keep > 0:
+            self.kept.append(targets[-1])
+            while len(self.kept) > self.keep:
+                os.remove(self.kept.pop(0))
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def on_train_end(self, logs=None):
+        self.wait()
+        self.writer.shutdown()
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+class StepTimeLogger(tf.keras.callbacks.Callback):
+    """Every `every` train steps computes the mean step time, events/s and
+    particles/s, and the mean time of each train_step component of a model
+    compiled with instrument=True. Each window is appended to the jsonl file
+    if given, the last one of an epoch is added to the epoch logs for
+    WandbMetricsLogger. profile_steps=(start,stop) captures a tf.profiler
+    trace of those train steps in profile_dir."""
+    def __init__(self, every=100, jsonl=None, profile_steps=None, profile_dir='profile'):
+        super().__init__()
+        self.every = every
+        self.jsonl = jsonl
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.profiling = False
+
+    def on_train_begin(self, logs=None):
+        self.step = 0
+        self.stats = {}
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.window_start = None
+        if getattr(self.model, 'step_timer', None) is not None:
+            self.model.step_timer.read()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps is not None and self.step == self.profile_steps[0]:
+            tf.profiler.experimental.start(self.profile_dir)
+            self.profiling = True
+        if self.window_start is None:
+            self.window_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        self.count += 1
+        if self.profiling and self.step == self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self.profiling = False
+        if self.every > 0 and self.count == self.every:
+            self.log_window()
+
+    def log_window(self):
+        timer = getattr(self.model, 'step_timer', None)
+        #Reading the timer waits for the steps to finish
+        totals = timer.read() if timer is not None else {}
+        elapsed = time.perf_counter() - self.window_start
+        self.stats = {'timing/step': elapsed/self.count}
+        if totals:
+            steps = totals.pop('steps')
+            self.stats['timing/events_per_second'] = totals.pop('events')/elapsed
+            self.stats['timing/particles_per_second'] = totals.pop('particles')/elapsed
+            self.stats.update({f'timing/{name}': total/steps for name, total in totals.items()})
+        if self.jsonl is not None:
+            with open(self.jsonl, 'a') as fout:
+                fout.write(json.dumps({'step': self.step, **self.stats}) + '\n')
+        self.reset()
+
+    def on_epoch_end(self, epoch, logs=None):
+        #Partial windows would include the validation time
+        self.reset()
+        if logs is not None:
+            logs.update(self.stats)
+
+    def on_train_end(self, logs=None):
+        if self.profiling:
+            tf.profiler.experimental.stop()
+            self.profiling = False